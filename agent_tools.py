@@ -1,77 +1,217 @@
 # agent_tools.py
 
-from typing import Optional, List
-from pydantic import Field, BaseModel, field_validator, ConfigDict
-import pdfplumber
+from typing import Optional, List, Dict
 import urllib3
+import asyncio
 import time
 import os
 import io
 import re
+import socket
+import tempfile
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from concurrent.futures import Future
 from dotenv import load_dotenv
 import streamlit as st
 from streamlit.runtime.scriptrunner import get_script_run_ctx
 from langchain_core.tools import tool
-from state import SearchPapersInput
+from state import SearchPapersInput, DownloadPaperInput
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:  # orjson es opcional; json de la stdlib como respaldo
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
 
 load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Caché DNS con TTL para las conexiones de los pools de este módulo: las descargas
+# de PDFs repiten pocos hosts y evitan así una resolución por conexión nueva.
+# No se parchea urllib3 globalmente: requests, OpenAI, etc. resuelven como siempre
+_DNS_CACHE: Dict[tuple, tuple] = {}
+_DNS_CACHE_LOCK = threading.Lock()
+_DNS_CACHE_TTL = 300.0
+
+def _resolve_host(host: str, port: int) -> List[str]:
+    now = time.monotonic()
+    with _DNS_CACHE_LOCK:
+        cached = _DNS_CACHE.get((host, port))
+        if cached and cached[0] > now:
+            return cached[1]
+
+    infos = socket.getaddrinfo(host, port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    with _DNS_CACHE_LOCK:
+        _DNS_CACHE[(host, port)] = (now + _DNS_CACHE_TTL, addresses)
+    return addresses
+
+class _CachedDNSMixin:
+    """Conecta a las IPs cacheadas del host; SNI y verificación TLS siguen usando self.host."""
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = _resolve_host(host, self.port)
+        except OSError:
+            return super()._new_conn()
+
+        error = None
+        for ip in addresses:
+            self._dns_host = ip
+            try:
+                return super()._new_conn()
+            except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError) as e:
+                error = e
+            finally:
+                self._dns_host = host
+
+        # Ninguna dirección cacheada respondió: se descarta la entrada y se resuelve de nuevo
+        with _DNS_CACHE_LOCK:
+            _DNS_CACHE.pop((host, self.port), None)
+        if error is not None:
+            raise error
+        return super()._new_conn()
+
+class _CachedDNSHTTPConnection(_CachedDNSMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class _CachedDNSHTTPSConnection(_CachedDNSMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class _CachedDNSHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _CachedDNSHTTPConnection
+
+class _CachedDNSHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _CachedDNSHTTPSConnection
+
+_CACHED_DNS_POOL_CLASSES = {
+    "http": _CachedDNSHTTPConnectionPool,
+    "https": _CachedDNSHTTPSConnectionPool
+}
+
+# Configuración inmutable compartida (Retry/Timeout/cabeceras) construida una sola vez
+_CORE_RETRY = urllib3.Retry(
+    total=5,
+    backoff_factor=2,
+    status_forcelist=[429, 500, 502, 503, 504]
+)
+_CORE_HEADERS = {
+    "User-Agent": "ScientificResearchAgent/2.0 (contact: tu@email.com)",
+    "Accept": "application/json"
+}
+_DL_RETRY = urllib3.Retry(
+    total=3,
+    redirect=5,
+    backoff_factor=2,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "HEAD"]
+)
+_DL_TIMEOUT = urllib3.Timeout(connect=15.0, read=30.0)
+
+# Pools compartidos a nivel de módulo: reutilizan conexiones keep-alive entre llamadas
+_CORE_POOL = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=16,
+    retries=_CORE_RETRY
+)
+_DL_POOL = urllib3.PoolManager(
+    num_pools=32,
+    maxsize=8,
+    cert_reqs='CERT_REQUIRED',
+    retries=_DL_RETRY,
+    timeout=_DL_TIMEOUT
+)
+# Solo los pools de este módulo usan la caché DNS
+_CORE_POOL.pool_classes_by_scheme = _CACHED_DNS_POOL_CLASSES
+_DL_POOL.pool_classes_by_scheme = _CACHED_DNS_POOL_CLASSES
+
+_WORD_SPLIT_RE = re.compile(r'\W+')
+
+# Caché en proceso de búsquedas CORE: (consulta normalizada, top_k) -> (timestamp, resultado)
+_SEARCH_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+_SEARCH_CACHE_LOCK = threading.Lock()
+_SEARCH_CACHE_MAXSIZE = 256
+_SEARCH_CACHE_TTL = 120.0
+_SEARCH_IN_FLIGHT: Dict[tuple, Future] = {}
+
+# Caché de texto extraído de PDFs: L1 en proceso + disco direccionado por sha256(url)
+_PDF_CACHE_DIR = Path.home() / ".cache" / "scientific_research_agent" / "pdf_text"
+_PDF_MEMORY_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+_PDF_MEMORY_LOCK = threading.Lock()
+_PDF_MEMORY_MAXSIZE = 128
+# Misma regla de frescura para ambos niveles: una entrada se sirve sin red durante
+# _PDF_FRESH_TTL; después se revalida (ETag/Last-Modified) o se descarga de nuevo.
+# Pasado _PDF_DISK_TTL se elimina
+_PDF_FRESH_TTL = 24 * 3600
+_PDF_DISK_TTL = 7 * 24 * 3600
+# Tope de la caché en disco; se poda como mucho cada _PDF_PRUNE_INTERVAL segundos
+_PDF_DISK_MAX_BYTES = 200 * 1024 * 1024
+_PDF_PRUNE_INTERVAL = 600.0
+_pdf_last_prune = float("-inf")
 
-class CoreAPIWrapper(BaseModel):
+_CORE_CLIENT: Optional["CoreAPIWrapper"] = None
+
+# Metadatos de los papers devueltos por search-papers, indexados por URL
+_RECENT_PAPERS: "OrderedDict[str, dict]" = OrderedDict()
+_RECENT_PAPERS_LOCK = threading.Lock()
+_RECENT_PAPERS_MAXSIZE = 512
+
+_PDF_MAX_CHARS = 15000
+_PDF_MIN_SAMPLE_CHARS = 50
+_PDF_MIN_PAGE_CHARS = 20
+_PDF_MAX_PAGES = 80
+_PDF_MAX_BYTES = 50 * 1024 * 1024
+_PDF_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+_PDF_CHUNK_SIZE = 64 * 1024
+_DL_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
+}
+
+@dataclass(slots=True)
+class CoreAPIWrapper:
     """Wrapper para la API de CORE con manejo avanzado de errores."""
-    model_config = ConfigDict(extra='forbid', validate_assignment=True)
-    
-    base_url: str = Field(
-        default="https://api.core.ac.uk/v3",
-        description="Endpoint principal de la API de CORE"
-    )
-    api_key: str = Field(
-        default_factory=lambda: os.getenv("CORE_API_KEY", ""),
-        description="API Key para autenticación en CORE"
-    )
-    top_k_results: int = Field(
-        default=3,
-        ge=1,
-        le=10,
-        description="Número máximo de resultados a retornar"
-    )
-
-    @field_validator("api_key")
-    @classmethod
-    def validate_api_key(cls, value: str) -> str:
-        if not value:
-            raise ValueError("CORE_API_KEY no encontrada en variables de entorno.")
-        return value
-
-    def _execute_api_request(self, query: str) -> dict:
-        http = urllib3.PoolManager(
-            retries=urllib3.Retry(
-                total=5,
-                backoff_factor=2,
-                status_forcelist=[429, 500, 502, 503, 504]
-            )
-        )
+    api_key: str
+    base_url: str = "https://api.core.ac.uk/v3"
+    top_k_results: int = 3
+    _headers: dict = field(init=False, repr=False)
+    _host_pool: urllib3.HTTPConnectionPool = field(init=False, repr=False)
+    _search_path: str = field(init=False, repr=False)
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "User-Agent": "ScientificResearchAgent/2.0 (contact: tu@email.com)",
-            "Accept": "application/json"
-        }
+    def __post_init__(self):
+        if not self.api_key:
+            raise ValueError("CORE_API_KEY no encontrada en variables de entorno.")
+        self._headers = {"Authorization": f"Bearer {self.api_key}", **_CORE_HEADERS}
+        # Pool del host resuelto una sola vez: evita re-parsear la URL en cada request
+        self._host_pool = _CORE_POOL.connection_from_url(self.base_url)
+        self._search_path = f"{urllib3.util.parse_url(self.base_url).path or ''}/search/outputs"
 
+    def _execute_api_request(self, query: str, top_k: int) -> dict:
         try:
-            response = http.request(
+            response = self._host_pool.request(
                 'GET',
-                f"{self.base_url}/search/outputs",
-                headers=headers,
+                self._search_path,
+                headers=self._headers,
                 fields={
                     "q": query,
-                    "limit": self.top_k_results,
+                    "limit": top_k,
                     "sort": "relevance:desc"
                 },
                 timeout=15.0
             )
             
             if response.status == 200:
-                return response.json()
+                return _json_loads(response.data)
             elif response.status == 429:
                 return {"error": "Límite de tasa excedido. Espere antes de hacer nuevas consultas."}
             else:
@@ -81,18 +221,63 @@ class CoreAPIWrapper(BaseModel):
             return {"error": f"Error de conexión: {str(e)}"}
 
     def _filter_relevant_results(self, results: list, query: str) -> list:
-        keywords = [kw.lower() for kw in re.split(r'\W+', query) if kw]
+        keywords = [kw for kw in _WORD_SPLIT_RE.split(query) if kw]
+        if not keywords:
+            return []
+
+        # Un único patrón case-insensitive en lugar de K búsquedas por paper
+        pattern = re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE)
         filtered = []
         for paper in results:
-            title = paper.get("title", "").lower()
-            abstract = paper.get("abstract", "").lower()
-            if any(kw in title or kw in abstract for kw in keywords):
+            if pattern.search(paper.get("title") or "") or pattern.search(paper.get("abstract") or ""):
                 filtered.append(paper)
         return filtered
 
-    def search(self, query: str) -> dict:
+    def search(self, query: str, top_k: Optional[int] = None) -> dict:
+        """Búsqueda con caché LRU + TTL por (consulta normalizada, top_k)."""
+        top_k = top_k or self.top_k_results
+        cache_key = (query.strip().casefold(), top_k)
+        now = time.monotonic()
+
+        with _SEARCH_CACHE_LOCK:
+            cached = _SEARCH_CACHE.get(cache_key)
+            if cached and now - cached[0] < _SEARCH_CACHE_TTL:
+                _SEARCH_CACHE.move_to_end(cache_key)
+                return cached[1]
+
+            # Coalescencia: consultas idénticas en vuelo comparten una sola petición
+            pending = _SEARCH_IN_FLIGHT.get(cache_key)
+            if pending is None:
+                pending = _SEARCH_IN_FLIGHT[cache_key] = Future()
+                is_owner = True
+            else:
+                is_owner = False
+
+        if not is_owner:
+            return pending.result()
+
         try:
-            response = self._execute_api_request(query)
+            result = self._search_uncached(query, top_k)
+
+            # Solo se cachean respuestas exitosas; los errores se reintentan
+            with _SEARCH_CACHE_LOCK:
+                if result.get("status") == "success":
+                    _SEARCH_CACHE[cache_key] = (now, result)
+                    _SEARCH_CACHE.move_to_end(cache_key)
+                    while len(_SEARCH_CACHE) > _SEARCH_CACHE_MAXSIZE:
+                        _SEARCH_CACHE.popitem(last=False)
+                _SEARCH_IN_FLIGHT.pop(cache_key, None)
+            pending.set_result(result)
+            return result
+        except BaseException as e:
+            with _SEARCH_CACHE_LOCK:
+                _SEARCH_IN_FLIGHT.pop(cache_key, None)
+            pending.set_exception(e)
+            raise
+
+    def _search_uncached(self, query: str, top_k: int) -> dict:
+        try:
+            response = self._execute_api_request(query, top_k)
             
             if "error" in response:
                 return {
@@ -113,20 +298,26 @@ class CoreAPIWrapper(BaseModel):
                 }
 
             formatted_results = []
-            for paper in filtered_results[:self.top_k_results]:
-                authors = [
-                    f"{a.get('given', '')} {a.get('family', '')}".strip()
-                    for a in paper.get("authors", [])
-                ]
+            for paper in filtered_results[:top_k]:
+                # Solo se formatean los 5 autores que se retornan
+                authors = []
+                for a in paper.get("authors") or ():
+                    name = " ".join(filter(None, (a.get("given"), a.get("family"))))
+                    if name:
+                        authors.append(name)
+                        if len(authors) == 5:
+                            break
                 
-                formatted_results.append({
+                formatted_paper = {
                     "title": paper.get("title", "Sin título"),
                     "id": paper.get("id"),
                     "publication_date": paper.get("publishedDate") or paper.get("yearPublished"),
-                    "authors": authors[:5],
+                    "authors": authors,
                     "urls": paper.get("sourceFulltextUrls", []),
                     "abstract": (paper.get("abstract") or "")[:500]
-                })
+                }
+                formatted_results.append(formatted_paper)
+                _remember_paper_metadata(formatted_paper)
             
             return {
                 "status": "success",
@@ -141,14 +332,39 @@ class CoreAPIWrapper(BaseModel):
                 "message": str(e)
             }
 
-@tool("search-papers", args_schema=SearchPapersInput)
-def search_papers(query: str, max_papers: int = 3) -> dict:
+def _remember_paper_metadata(paper: dict) -> None:
+    """Indexa los metadatos de un paper por cada una de sus URLs para download-paper(mode="metadata")."""
+    metadata = {
+        "title": paper["title"],
+        "authors": paper["authors"],
+        "publication_date": paper["publication_date"],
+        "abstract": paper["abstract"]
+    }
+    with _RECENT_PAPERS_LOCK:
+        for url in paper["urls"] or ():
+            _RECENT_PAPERS[url] = metadata
+            _RECENT_PAPERS.move_to_end(url)
+        while len(_RECENT_PAPERS) > _RECENT_PAPERS_MAXSIZE:
+            _RECENT_PAPERS.popitem(last=False)
+
+def _get_core_client() -> CoreAPIWrapper:
     """
-    Busca artículos científicos en la API de CORE según la consulta proporcionada.
-    Ejemplo de entrada: {"query": "machine learning in healthcare", "max_papers": 5}
+    Cliente CORE compartido. CORE_API_KEY se lee del entorno una sola vez,
+    en el primer uso exitoso, y no en cada llamada a la herramienta.
     """
+    global _CORE_CLIENT
+    if _CORE_CLIENT is None:
+        _CORE_CLIENT = CoreAPIWrapper(api_key=os.getenv("CORE_API_KEY", ""))
+    return _CORE_CLIENT
+
+def reset_core_client() -> None:
+    """Descarta el cliente CORE para que la próxima búsqueda relea CORE_API_KEY."""
+    global _CORE_CLIENT
+    _CORE_CLIENT = None
+
+def _search_papers_sync(query: str, max_papers: int) -> dict:
     try:
-        return CoreAPIWrapper(top_k_results=max_papers).search(query)
+        return _get_core_client().search(query, max_papers)
     except Exception as e:
         return {
             "status": "error",
@@ -156,23 +372,118 @@ def search_papers(query: str, max_papers: int = 3) -> dict:
             "message": f"Fallo en search_papers: {str(e)}"
         }
 
-@tool("download-paper")
-def download_paper(url: str) -> dict:
+@tool("search-papers", args_schema=SearchPapersInput)
+async def search_papers(query: str, max_papers: int = 3) -> dict:
     """
-    Descarga y extrae texto de un documento científico en PDF, dado su URL.
+    Busca artículos científicos en la API de CORE según la consulta proporcionada.
+    Ejemplo de entrada: {"query": "machine learning in healthcare", "max_papers": 5}
+    """
+    # El cliente urllib3 agrupado es thread-safe y sobrevive entre event loops
+    return await asyncio.to_thread(_search_papers_sync, query, max_papers)
 
-    Args:
-        url: URL válida de un documento PDF
+@lru_cache(maxsize=None)
+def _get_fitz():
+    """Importa PyMuPDF en el primer uso: su carga encarece el arranque de Streamlit."""
+    import fitz
 
-    Retorna:
-        dict: Resultado con estructura:
-        {
-            "status": "success"|"error",
-            "url": str,
-            "pages_processed": int,
-            "content": str,
-            "warnings": List[str]
-        }
+    # MuPDF escribe un mensaje por cada objeto defectuoso; en PDFs problemáticos
+    # ese volumen de salida domina el tiempo de extracción bajo hosts verbosos
+    fitz.TOOLS.mupdf_display_errors(False)
+    fitz.TOOLS.mupdf_display_warnings(False)
+    return fitz
+
+def _open_pdf(source) -> "fitz.Document":
+    """Abre un PDF desde bytes en memoria o desde una ruta en disco (que fitz mapea sin copiarla)."""
+    fitz = _get_fitz()
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source, filetype="pdf")
+
+def _spool_response(response):
+    """
+    Vuelca el cuerpo de la respuesta por bloques: en memoria hasta 8 MB y,
+    por encima, a un archivo temporal. Retorna los bytes o la ruta del archivo,
+    que el llamador debe eliminar.
+    """
+    buffer = io.BytesIO()
+    spool_file = None
+    total_bytes = 0
+    try:
+        for chunk in response.stream(_PDF_CHUNK_SIZE):
+            # Límite efectivo aunque el servidor omita o falsee Content-Length
+            total_bytes += len(chunk)
+            if total_bytes > _PDF_MAX_BYTES:
+                raise ValueError(f"PDF demasiado grande: más de {_PDF_MAX_BYTES} bytes")
+            if spool_file is None and buffer.tell() + len(chunk) > _PDF_SPOOL_MAX_SIZE:
+                spool_file = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+                spool_file.write(buffer.getbuffer())
+                buffer = None
+            (spool_file or buffer).write(chunk)
+    except BaseException:
+        if spool_file is not None:
+            spool_file.close()
+            os.unlink(spool_file.name)
+        raise
+
+    if spool_file is None:
+        return buffer.getvalue()
+    spool_file.close()
+    return spool_file.name
+
+class _ImageOnlyPDFError(Exception):
+    """El PDF parece escaneado (solo imágenes); extraer su texto no aporta contenido."""
+    def __init__(self, page_count: int):
+        super().__init__("PDF de solo imágenes")
+        self.page_count = page_count
+
+def _is_image_only(doc: "fitz.Document", sample_chars: int) -> bool:
+    if sample_chars >= _PDF_MIN_SAMPLE_CHARS:
+        return False
+    return bool(doc.load_page(0).get_images())
+
+def _extract_pages_fitz(source) -> tuple:
+    """
+    Extrae texto con PyMuPDF; retorna (total de páginas, textos, páginas omitidas).
+    Se detiene en cuanto el texto acumulado alcanza el límite de caracteres
+    (o tras 80 páginas) y omite páginas casi sin texto, como las de figuras.
+    """
+    text_content = []
+    total_chars = 0
+    skipped_pages = 0
+
+    def _accumulate(text: str) -> bool:
+        """Agrega el texto de una página; retorna True al alcanzar el límite."""
+        nonlocal total_chars, skipped_pages
+        if len(text.strip()) < _PDF_MIN_PAGE_CHARS:
+            skipped_pages += 1
+            return False
+        text_content.append(text)
+        total_chars += len(text) + 1
+        return total_chars >= _PDF_MAX_CHARS
+
+    # Extracción en serie: PyMuPDF no admite hilos (ni con un Document por hilo) y
+    # mantiene el GIL; la lectura se detiene en cuanto se alcanza el límite de caracteres
+    with _open_pdf(source) as doc:
+        page_count = doc.page_count
+        n_pages = min(_PDF_MAX_PAGES, page_count)
+        sample_chars = 0
+        for i in range(n_pages):
+            text = doc.load_page(i).get_text("text")
+            if i < 2:
+                sample_chars += len(text.strip())
+            if _accumulate(text):
+                break
+
+            # PDF escaneado: las primeras páginas no tienen texto pero sí imágenes
+            if i == min(n_pages, 2) - 1 and _is_image_only(doc, sample_chars):
+                raise _ImageOnlyPDFError(page_count)
+
+    return page_count, text_content, skipped_pages
+
+def _parse_pdf(source, url: str) -> dict:
+    """
+    Extrae el texto de un PDF ya descargado (hasta 80 páginas y 15,000 caracteres).
+    `source` son los bytes del PDF o la ruta de un archivo temporal.
     """
     result_template = {
         "status": "success",
@@ -183,54 +494,257 @@ def download_paper(url: str) -> dict:
     }
 
     try:
-        if not re.match(r'^https?://', url):
+        page_count, text_content, skipped_pages = _extract_pages_fitz(source)
+    except _get_fitz().FileDataError as e:
+        raise ValueError(f"PDF dañado o ilegible: {str(e)}") from e
+    except _ImageOnlyPDFError as e:
+        result_template["status"] = "skipped"
+        result_template["reason"] = "image-only PDF"
+        result_template["pages_processed"] = e.page_count
+        result_template["warnings"].append(
+            "PDF escaneado sin capa de texto; se omitió la extracción"
+        )
+        return result_template
+
+    result_template["pages_processed"] = page_count
+
+    # Escritura acotada: nunca se materializa más texto que el que se retorna
+    buffer = io.StringIO()
+    remaining = _PDF_MAX_CHARS
+    truncated = False
+    for i, text in enumerate(text_content):
+        if i:
+            text = "\n" + text
+        if len(text) > remaining:
+            buffer.write(text[:remaining])
+            truncated = True
+            break
+        buffer.write(text)
+        remaining -= len(text)
+    result_template["content"] = buffer.getvalue()
+    
+    if truncated:
+        result_template["warnings"].append(
+            "Texto truncado a 15,000 caracteres"
+        )
+    if skipped_pages:
+        result_template["warnings"].append(
+            f"{skipped_pages} páginas con poco texto omitidas (figuras o páginas en blanco)"
+        )
+    
+    return result_template
+
+def _pdf_cache_path(url: str) -> Path:
+    return _PDF_CACHE_DIR / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
+
+def _pdf_age(entry: dict) -> float:
+    return time.time() - entry.get("fetched_at", 0)
+
+def _get_cached_pdf(url: str) -> Optional[dict]:
+    """Entrada cacheada no expirada: primero la caché L1 en proceso, luego la de disco."""
+    with _PDF_MEMORY_LOCK:
+        entry = _PDF_MEMORY_CACHE.get(url)
+        if entry is not None:
+            if _pdf_age(entry) < _PDF_DISK_TTL:
+                _PDF_MEMORY_CACHE.move_to_end(url)
+                return entry
+            del _PDF_MEMORY_CACHE[url]
+
+    path = _pdf_cache_path(url)
+    try:
+        entry = _json_loads(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+    if _pdf_age(entry) >= _PDF_DISK_TTL:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+        return None
+    return entry
+
+def _remember_pdf(url: str, entry: dict) -> None:
+    with _PDF_MEMORY_LOCK:
+        _PDF_MEMORY_CACHE[url] = entry
+        _PDF_MEMORY_CACHE.move_to_end(url)
+        while len(_PDF_MEMORY_CACHE) > _PDF_MEMORY_MAXSIZE:
+            _PDF_MEMORY_CACHE.popitem(last=False)
+
+def _store_pdf(url: str, result: dict, headers) -> None:
+    """Persiste el texto extraído junto con los validadores HTTP para revalidar después."""
+    entry = {
+        "status": result["status"],
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "content": result["content"],
+        "pages_processed": result["pages_processed"],
+        "warnings": result["warnings"],
+        "fetched_at": time.time()
+    }
+    _write_pdf_entry(url, entry)
+
+def _write_pdf_entry(url: str, entry: dict) -> None:
+    """Guarda la entrada en memoria y en disco (escritura atómica)."""
+    _remember_pdf(url, entry)
+
+    path = _pdf_cache_path(url)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(_json_dumps(entry))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"No se pudo escribir la caché de PDF: {str(e)}")
+    _maybe_prune_pdf_cache()
+
+def _maybe_prune_pdf_cache() -> None:
+    """Elimina las entradas de disco expiradas y, si se supera el tope, las más antiguas."""
+    global _pdf_last_prune
+    now = time.monotonic()
+    with _PDF_MEMORY_LOCK:
+        if now - _pdf_last_prune < _PDF_PRUNE_INTERVAL:
+            return
+        _pdf_last_prune = now
+
+    files = []
+    expires_before = time.time() - _PDF_DISK_TTL
+    for path in _PDF_CACHE_DIR.glob("*.json"):
+        try:
+            stat = path.stat()
+            if stat.st_mtime < expires_before:
+                path.unlink()
+            else:
+                files.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            continue
+
+    total_bytes = sum(size for _, size, _ in files)
+    if total_bytes <= _PDF_DISK_MAX_BYTES:
+        return
+    for _, size, path in sorted(files):
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total_bytes -= size
+        if total_bytes <= _PDF_DISK_MAX_BYTES:
+            break
+
+def _is_fresh(entry: Optional[dict]) -> bool:
+    """Una entrada reciente se sirve sin revalidar, venga de memoria o de disco."""
+    return entry is not None and _pdf_age(entry) < _PDF_FRESH_TTL
+
+def _can_revalidate(entry: Optional[dict]) -> bool:
+    return entry is not None and bool(entry.get("etag") or entry.get("last_modified"))
+
+def _revalidation_headers(entry: Optional[dict]) -> dict:
+    headers = dict(_DL_HEADERS)
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def _result_from_cache(url: str, entry: dict) -> dict:
+    return {
+        "status": entry.get("status", "success"),
+        "url": url,
+        "pages_processed": entry["pages_processed"],
+        "content": entry["content"],
+        "warnings": list(entry.get("warnings", []))
+    }
+
+def _check_pdf_headers(headers) -> None:
+    """Rechaza respuestas que no son PDF o que exceden el tamaño máximo declarado."""
+    content_type = headers.get('Content-Type', '')
+    if 'pdf' not in content_type.lower():
+        raise ValueError(f"Contenido no es PDF: {content_type}")
+
+    content_length = int(headers.get('Content-Length') or 0)
+    if content_length > _PDF_MAX_BYTES:
+        raise ValueError(f"PDF demasiado grande: {content_length} bytes")
+
+def _precheck_pdf_url(url: str) -> None:
+    """HEAD previo para descartar URLs que no son PDF o son demasiado grandes sin bajar el cuerpo."""
+    try:
+        head = _DL_POOL.request('HEAD', url, headers=_DL_HEADERS, redirect=True)
+    except urllib3.exceptions.HTTPError as e:
+        logger.debug(f"HEAD falló para {url}: {str(e)}")
+        return
+
+    # Servidores que no soportan HEAD: la validación se hace sobre las cabeceras del GET
+    if head.status != 200:
+        return
+    _check_pdf_headers(head.headers)
+
+def _download_paper_sync(url: str, mode: str) -> dict:
+    try:
+        if not url.startswith(("http://", "https://")):
             raise ValueError("URL debe usar HTTP/HTTPS")
+
+        if mode == "metadata":
+            metadata = _RECENT_PAPERS.get(url)
+            if metadata is not None:
+                return {
+                    "status": "success",
+                    "url": url,
+                    "mode": "metadata",
+                    **metadata,
+                    "warnings": []
+                }
+
+        entry = _get_cached_pdf(url)
+        if _is_fresh(entry):
+            _remember_pdf(url, entry)
+            return _result_from_cache(url, entry)
+
+        # Entradas vencidas sin ETag/Last-Modified no se pueden revalidar: se descargan de nuevo
+        if not _can_revalidate(entry):
+            entry = None
+            _precheck_pdf_url(url)
         
-        http = urllib3.PoolManager(
-            cert_reqs='CERT_REQUIRED',
-            timeout=urllib3.Timeout(connect=15.0, read=30.0)
+        # Los reintentos con backoff los gestiona el Retry del pool (_DL_RETRY)
+        response = _DL_POOL.request(
+            'GET',
+            url,
+            headers=_revalidation_headers(entry),
+            preload_content=False
         )
-        
-        for attempt in range(3):
-            try:
-                response = http.request(
-                    'GET',
-                    url,
-                    headers={
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
-                    }
-                )
-                
-                if response.status != 200:
-                    raise ConnectionError(f"HTTP Error {response.status}")
-                    
-                content_type = response.headers.get('Content-Type', '')
-                if 'pdf' not in content_type.lower():
-                    raise ValueError(f"Contenido no es PDF: {content_type}")
-                    
-                with pdfplumber.open(io.BytesIO(response.data)) as pdf:
-                    result_template["pages_processed"] = len(pdf.pages)
-                    text_content = []
-                    
-                    for page in pdf.pages[:50]:
-                        text = page.extract_text() or ""
-                        text_content.append(text)
-                    
-                    full_text = "\n".join(text_content)
-                    result_template["content"] = full_text[:15000]
-                    
-                    if len(full_text) > 15000:
-                        result_template["warnings"].append(
-                            "Texto truncado a 15,000 caracteres"
-                        )
-                    
-                    return result_template
-
-            except Exception as e:
-                if attempt == 2:
-                    raise
-                time.sleep(2 ** (attempt + 1))
+
+        body_read = False
+        try:
+            if response.status == 304 and entry is not None:
+                # 304 no tiene cuerpo: la conexión queda lista para reutilizarse
+                response.drain_conn()
+                body_read = True
+                # Revalidada: vuelve a contar como fresca en ambos niveles
+                entry = {**entry, "fetched_at": time.time()}
+                _write_pdf_entry(url, entry)
+                return _result_from_cache(url, entry)
+            
+            if response.status != 200:
+                raise ConnectionError(f"HTTP Error {response.status}")
                 
+            _check_pdf_headers(response.headers)
+
+            source = _spool_response(response)
+            body_read = True
+        finally:
+            # Con el cuerpo sin leer (error, PDF demasiado grande o lectura abortada) la
+            # conexión se cierra antes de devolverla: el siguiente uso abre una nueva
+            if not body_read:
+                response.close()
+            response.release_conn()
+
+        try:
+            result = _parse_pdf(source, url)
+        finally:
+            if isinstance(source, str):
+                os.unlink(source)
+        _store_pdf(url, result, response.headers)
+        return result
+
     except Exception as e:
         return {
             "status": "error",
@@ -239,6 +753,48 @@ def download_paper(url: str) -> dict:
             "url": url
         }
 
+@tool("download-paper", args_schema=DownloadPaperInput)
+async def download_paper(url: str, mode: str = "text") -> dict:
+    """
+    Descarga y extrae texto de un documento científico en PDF, dado su URL.
+    Usa mode="metadata" cuando el título, autores y abstract de una búsqueda
+    previa sean suficientes: evita descargar y procesar el PDF.
+
+    Args:
+        url: URL válida de un documento PDF
+        mode: "text" para el texto completo, "metadata" para los metadatos en caché
+
+    Retorna:
+        dict: Resultado con estructura:
+        {
+            "status": "success"|"error",
+            "url": str,
+            "pages_processed": int,
+            "content": str,
+            "warnings": List[str]
+        }
+        En modo "metadata" (si la URL proviene de search-papers) retorna
+        "title", "authors", "publication_date" y "abstract" en lugar del contenido.
+    """
+    return await asyncio.to_thread(_download_paper_sync, url, mode)
+
+def _detect_streamlit() -> bool:
+    try:
+        return get_script_run_ctx() is not None and hasattr(st, 'session_state')
+    except Exception:
+        return False
+
+# Se asume que un proceso sirve un solo modo (app Streamlit o consola): el modo
+# se detecta una vez al importar, ya que las herramientas se ejecutan en hilos
+# de trabajo donde el contexto del script no está disponible
+_IN_STREAMLIT = _detect_streamlit()
+
+@lru_cache(maxsize=512)
+def _feedback_key(question: str) -> str:
+    # hash() está salteado por proceso; blake2b da una clave estable entre procesos
+    digest = hashlib.blake2b(question.encode("utf-8"), digest_size=8).hexdigest()
+    return f"human_feedback_{digest}"
+
 @tool("ask-human-feedback")
 def ask_human_feedback(question: str) -> str:
     """
@@ -250,17 +806,15 @@ def ask_human_feedback(question: str) -> str:
     Returns:
         str: Respuesta del usuario
     """
-    ctx = get_script_run_ctx()
-    
-    if ctx and hasattr(st, 'session_state'):
-        key = f"human_feedback_{hash(question)}"
+    if _IN_STREAMLIT:
+        key = _feedback_key(question)
         if key not in st.session_state:
             with st.chat_message("assistant"):
                 st.markdown(f"**Confirmación Requerida:**\n{question}")
                 st.session_state[key] = st.text_input("Tu respuesta:", key=key)
                 
-                if st.button("Enviar Respuesta", key=f"{key}_button"):
-                    st.rerun()
+                # El clic ya provoca un rerun de Streamlit; no hace falta forzar otro
+                st.button("Enviar Respuesta", key=f"{key}_button")
             
             st.stop()
         
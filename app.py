@@ -5,15 +5,26 @@ import asyncio
 import streamlit as st
 from langchain_core.messages import AIMessage, HumanMessage
 from dotenv import load_dotenv
-from astream_events_handler import execute_research_flow
+from astream_events_handler import execute_research_flow, CycleLimitError
+from agent_tools import reset_core_client
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime
 import re
+import json
 import logging
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+_MD_FENCE_RE = re.compile(r"```markdown\n|\n```")
+
+try:
+    import uvloop
+    _new_event_loop = uvloop.new_event_loop
+except ImportError:  # uvloop es opcional (no disponible en Windows)
+    _new_event_loop = asyncio.new_event_loop
+
 # Configuración inicial de la página
 st.set_page_config(
     page_title="Investigador Científico IA",
@@ -22,23 +33,61 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+_AVATARS = {"assistant": "🔬", "user": "👤"}
+
 @contextmanager
-def handle_async_errors():
-    """Maneja errores asíncronos y muestra mensajes en la UI."""
+def handle_async_errors(error_placeholder):
+    """
+    Maneja errores asíncronos y muestra mensajes en la UI.
+
+    No fuerza un st.rerun(): el error se muestra en su placeholder y se guarda
+    en la sesión para que siga visible en la siguiente ejecución del script.
+    """
     try:
         yield
-    except RuntimeError as e:
-        st.error(f"🔁 Límite de iteraciones alcanzado: {str(e)}")
-        st.session_state.processing = False
-        st.rerun()
+    except CycleLimitError as e:
+        _report_error(error_placeholder, "error", f"🔁 Límite de iteraciones alcanzado: {str(e)}")
     except asyncio.CancelledError:
-        st.warning("⏹️ Investigación detenida por el usuario")
-        st.session_state.processing = False
-        st.rerun()
+        _report_error(error_placeholder, "warning", "⏹️ Investigación detenida por el usuario")
     except Exception as e:
-        st.error(f"🚨 Error crítico: {str(e)}")
-        st.session_state.processing = False
-        st.rerun()
+        _report_error(error_placeholder, "error", f"🚨 Error crítico: {str(e)}")
+
+def _report_error(error_placeholder, level: str, message: str):
+    st.session_state.last_error = (level, message)
+    st.session_state.processing = False
+    getattr(error_placeholder, level)(message)
+
+def show_last_error(error_placeholder):
+    """Muestra (una sola vez) el último error registrado en la sesión."""
+    last_error = st.session_state.pop("last_error", None)
+    if last_error:
+        level, message = last_error
+        getattr(error_placeholder, level)(message)
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop reutilizado entre mensajes de la sesión en lugar de crear uno
+    por mensaje con asyncio.run. Es por sesión (no cache_resource) porque dos
+    sesiones no pueden ejecutar el mismo loop a la vez.
+    """
+    loop = st.session_state.get("event_loop")
+    if loop is None or loop.is_closed():
+        loop = _new_event_loop()
+        st.session_state.event_loop = loop
+    return loop
+
+def run_async(coro):
+    """Ejecuta una corrutina en el loop de la sesión y drena las tareas huérfanas."""
+    loop = get_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        pending = [task for task in asyncio.all_tasks(loop) if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
 
 def setup_api_key():
     """Configuración segura de API Keys."""
@@ -70,16 +119,51 @@ def setup_api_key():
             # Guardar en variables de entorno y sesión
             os.environ["OPENAI_API_KEY"] = openai_key
             os.environ["CORE_API_KEY"] = core_key
+            reset_core_client()
             st.session_state.api_keys_set = True
             st.success("✅ Claves configuradas correctamente")
             st.rerun()
         
         # Botón para detener la investigación
         if st.sidebar.button("⏹️ Detener Investigación"):
-            # Opcional: si guardas un supervisor en session_state
-            if 'research_supervisor' in st.session_state:
-                st.session_state.research_supervisor.cancel_research()
-            st.rerun()
+            # execute_research_flow registra su supervisor mientras hay una investigación
+            # en curso; el flujo revisa la marca de cancelación en cada evento
+            supervisor = st.session_state.get("research_supervisor")
+            if supervisor is not None:
+                supervisor.cancel_research()
+
+def _set_messages(*messages):
+    """Reemplaza el historial manteniendo la lista paralela (rol, contenido) para el render."""
+    st.session_state.messages = list(messages)
+    st.session_state.rendered_messages = [
+        ("assistant" if isinstance(msg, AIMessage) else "user", msg.content)
+        for msg in messages
+    ]
+
+def _append_message(role: str, content: str):
+    """Añade un mensaje al historial etiquetando su rol una sola vez."""
+    message_cls = AIMessage if role == "assistant" else HumanMessage
+    st.session_state.messages.append(message_cls(content=content))
+    st.session_state.rendered_messages.append((role, content))
+
+_MAX_TOOL_EXECUTIONS = 128
+
+_SESSION_DEFAULTS = {
+    # Historial acotado: las ejecuciones más antiguas se descartan
+    "tool_executions": lambda: deque(maxlen=_MAX_TOOL_EXECUTIONS),
+    "research_data": lambda: {"current_cycle": 0, "max_cycles": 10},
+    "current_progress": float,
+    "expander_open": lambda: True,
+    "processing": bool,
+    "api_keys_set": bool
+}
+
+def _ensure_session_defaults():
+    """Inicializa una sola vez por ejecución todas las claves de sesión que usa la app."""
+    state = st.session_state
+    for key, factory in _SESSION_DEFAULTS.items():
+        if key not in state:
+            state[key] = factory()
 
 def initialize_chat():
     """Inicializa el estado del chat con al menos un mensaje del asistente."""
@@ -94,33 +178,26 @@ def initialize_chat():
     }
     
     if "messages" not in st.session_state:
-        st.session_state.messages = [
+        _set_messages(
             AIMessage(content="¡Hola! Soy tu asistente de investigación. ¿En qué tema deseas profundizar hoy?")
-        ]
+        )
         st.session_state.update(defaults)
     elif not st.session_state.messages:
-        st.session_state.messages = [
+        _set_messages(
             AIMessage(content="¡La conversación se reinició! ¿Sobre qué deseas investigar?")
-        ]
-    
-    if "processing" not in st.session_state:
-        st.session_state.processing = False
+        )
+    elif "rendered_messages" not in st.session_state:
+        _set_messages(*st.session_state.messages)
+
 
 def render_chat_history():
     """Renderiza el historial del chat con formato básico."""
-    for msg in st.session_state.messages:
-        if isinstance(msg, AIMessage):
-            with st.chat_message("assistant", avatar="🔬"):
-                st.markdown(msg.content)
-        elif isinstance(msg, HumanMessage):
-            with st.chat_message("user", avatar="👤"):
-                st.markdown(msg.content)
+    for role, content in st.session_state.rendered_messages:
+        with st.chat_message(role, avatar=_AVATARS[role]):
+            st.markdown(content)
 
 def show_welcome_expander():
     """Muestra el panel de bienvenida inicial."""
-    if "expander_open" not in st.session_state:
-        st.session_state.expander_open = True
-
     if st.session_state.expander_open:
         with st.expander("🚀 Bienvenido al Investigador Científico IA", expanded=True):
             st.markdown("""
@@ -140,17 +217,24 @@ def show_welcome_expander():
 
 def clear_conversation():
     """Reinicia la conversación con al menos un mensaje del asistente."""
-    st.session_state.messages = [
+    _set_messages(
         AIMessage(content="¡Conversación reiniciada! ¿En qué tema deseas profundizar ahora?")
-    ]
+    )
     st.session_state.processing = False
     st.rerun()
 
+def _tool_json(tool: dict, field: str) -> str:
+    """Serializa input/output de una herramienta una sola vez y lo guarda en su registro."""
+    cache_key = f"_rendered_{field}_json"
+    rendered = tool.get(cache_key)
+    if rendered is None:
+        rendered = json.dumps(tool[field], ensure_ascii=False, indent=2, default=str)
+        tool[cache_key] = rendered
+    return rendered
+
+@st.fragment
 def show_tool_monitoring():
     """Muestra el panel de herramientas ejecutadas."""
-    if "tool_executions" not in st.session_state:
-        st.session_state.tool_executions = []
-    
     with st.expander("🔍 **Supervisión de Herramientas Ejecutadas**", expanded=True):
         if not st.session_state.tool_executions:
             st.info("No se han ejecutado herramientas aún")
@@ -168,12 +252,12 @@ def show_tool_monitoring():
                 
                 with cols[1]:
                     with st.expander("📥 **Input**", expanded=False):
-                        st.json(tool["input"], expanded=False)
+                        st.code(_tool_json(tool, "input"), language="json")
                     
                     if tool["output"]:
                         with st.expander("📤 **Output**", expanded=False):
                             if isinstance(tool["output"], dict):
-                                st.json(tool["output"])
+                                st.code(_tool_json(tool, "output"), language="json")
                             else:
                                 st.code(str(tool["output"]), language="text")
                     else:
@@ -181,12 +265,16 @@ def show_tool_monitoring():
 
 def main():
     st.title("🔍 Investigador Científico Asistido por IA")
+    error_placeholder = st.empty()
+    show_last_error(error_placeholder)
+    # Claves de sesión inicializadas en una única fase
+    _ensure_session_defaults()
     
     # Configura la sección lateral para ingresar las claves
     setup_api_key()
     
     # Verifica que las claves estén configuradas
-    if not st.session_state.get("api_keys_set", False):
+    if not st.session_state.api_keys_set:
         st.info("⚠️ Configura tus API Keys en la barra lateral")
         return
 
@@ -206,18 +294,18 @@ def main():
             return
 
         st.session_state.processing = True
-        st.session_state.messages.append(HumanMessage(content=prompt))
+        _append_message("user", prompt)
         
-        with st.chat_message("user", avatar="👤"):
+        with st.chat_message("user", avatar=_AVATARS["user"]):
             st.markdown(prompt)
 
-        with st.chat_message("assistant", avatar="🔬"):
+        with st.chat_message("assistant", avatar=_AVATARS["assistant"]):
             placeholder = st.empty()
             
-            with handle_async_errors(), st.spinner("🔍 Analizando consulta..."):
+            with handle_async_errors(error_placeholder), st.spinner("🔍 Analizando consulta..."):
                 try:
                     # Llamada asíncrona para ejecutar el flujo de investigación
-                    response = asyncio.run(
+                    response = run_async(
                         execute_research_flow(
                             st.session_state.messages,
                             placeholder
@@ -226,9 +314,8 @@ def main():
                     
                     if response:
                         # Limpieza de formato (quitamos ```markdown si viene en la respuesta)
-                        clean_response = re.sub(r"```markdown\n|\n```", "", response)
-                        final_message = AIMessage(content=clean_response)
-                        st.session_state.messages.append(final_message)
+                        clean_response = _MD_FENCE_RE.sub("", response)
+                        _append_message("assistant", clean_response)
                 finally:
                     st.session_state.processing = False
 
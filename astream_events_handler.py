@@ -3,26 +3,26 @@
 import asyncio
 import time
 import logging
-from typing import Dict, Any
+import reprlib
+from collections import deque
+from typing import Dict, Any, List, Set
 import streamlit as st
 
-from langchain_core.messages import BaseMessage
-from graph import app_runnable
-
 logger = logging.getLogger(__name__)
 
+# Frecuencia máxima de re-render del texto en streaming
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_CHARS = 256
+
+class CycleLimitError(Exception):
+    """Se superó el número máximo de ciclos de investigación."""
+
+
 class ResearchSupervisor:
     """Clase mejorada para gestionar el ciclo de investigación."""
     def __init__(self):
-        if "research_data" not in st.session_state:
-            st.session_state.research_data = {
-                "executions": [],
-                "current_cycle": 0,
-                "max_cycles": 10
-            }
-        
-        self.tools: Dict[str, Dict[str, Any]] = {}
         self._cancelled = False
+        self._last_pushed = -1
 
     def cancel_research(self):
         """Maneja la cancelación limpia de la investigación."""
@@ -31,17 +31,182 @@ class ResearchSupervisor:
         st.toast("🛑 Investigación detenida", icon="⏹️")
 
     def update_progress(self, progress: float, message: str):
-        """Actualiza la barra de progreso de forma segura."""
+        """Actualiza la barra de progreso solo si cambia el porcentaje visible."""
+        percent = int(min(progress, 1.0) * 100)
+        if percent == self._last_pushed:
+            return
+
         try:
             if 'progress_bar' in st.session_state:
                 st.session_state.progress_bar.progress(
                     min(progress, 1.0), 
                     text=message
                 )
+                self._last_pushed = percent
         except Exception as e:
             logger.error(f"Error actualizando progreso: {str(e)}")
 
 
+# Nodo del grafo cuyos tokens se muestran al usuario
+_ANSWER_NODE = "agent"
+
+# Cola entre el stream del grafo y el render de Streamlit
+EVENT_QUEUE_SIZE = 256
+_STREAM_END = object()
+
+# Eventos entre actualizaciones de la barra de progreso
+UI_EVENT_BUDGET = 16
+
+# repr acotado: no materializa el repr completo de outputs grandes
+_SHORT_REPR = reprlib.Repr()
+_SHORT_REPR.maxstring = 500
+_SHORT_REPR.maxother = 500
+
+
+def _truncate_text(obj: Any, max_length: int = 500) -> str:
+    """Texto acotado de obj; los strings cortos se devuelven sin copiar."""
+    text = obj if isinstance(obj, str) else _SHORT_REPR.repr(obj)
+    if len(text) <= max_length:
+        return text
+    half = max_length // 2
+    return f"{text[:half]}\n... [TRUNC] ...\n{text[-half:]}"
+
+
+def _output_size(output: Any) -> str:
+    """Tamaño legible del output sin serializarlo completo."""
+    content = getattr(output, "content", output)
+    return f"{len(content)} caracteres" if isinstance(content, str) else type(content).__name__
+
+
+# Peso de cada tipo de evento en la barra de progreso
+_PROGRESS_STREAM = 0.05
+_PROGRESS_TOOL_START = 0.1
+_PROGRESS_TOOL_END = 0.2
+# Tope de la barra durante el stream; el 100% se marca al terminar
+_PROGRESS_CAP = 0.95
+
+
+class _FlowState:
+    """Estado mutable del flujo compartido por los manejadores de eventos."""
+    __slots__ = ("text_slot", "tools_area", "running_tools", "final_chunks", "streamed_runs",
+                 "last_flush", "pending_chars", "tool_executions", "research_data")
+
+    def __init__(self, text_slot, tools_area, tool_executions: deque, research_data: dict):
+        # Layout persistente: un slot por herramienta y un único slot para el texto
+        self.text_slot = text_slot
+        self.tools_area = tools_area
+        # run_id -> registro de las herramientas en curso
+        self.running_tools: Dict[str, Dict[str, Any]] = {}
+        self.final_chunks: List[str] = []
+        # Ejecuciones del modelo que emitieron tokens; las respuestas servidas desde
+        # la caché LLM no emiten on_chat_model_stream
+        self.streamed_runs: Set[str] = set()
+        self.last_flush = time.monotonic()
+        self.pending_chars = 0
+        self.tool_executions = tool_executions
+        self.research_data = research_data
+
+
+def _handle_chain_start(data: Dict[str, Any], name: str, run_id: str, state: _FlowState):
+    # Manejo de ciclos de investigación
+    if name != "planning":
+        return
+    research_data = state.research_data
+    research_data["current_cycle"] += 1
+    logger.debug(f"Ciclo de investigación #{research_data['current_cycle']}")
+
+    if research_data["current_cycle"] > research_data["max_cycles"]:
+        raise CycleLimitError("🔬 Límite máximo de ciclos alcanzado. Revisa los parámetros de búsqueda.")
+
+
+def _append_text(chunk: str, state: _FlowState):
+    state.final_chunks.append(chunk)
+    state.pending_chars += len(chunk)
+
+    # Render acotado a ~20 Hz o cada 256 caracteres, no por token
+    now = time.monotonic()
+    if now - state.last_flush > STREAM_FLUSH_INTERVAL or state.pending_chars > STREAM_FLUSH_CHARS:
+        state.text_slot.markdown(f"```markdown\n{''.join(state.final_chunks)}\n```")
+        state.last_flush = now
+        state.pending_chars = 0
+
+
+def _handle_stream(data: Dict[str, Any], name: str, run_id: str, state: _FlowState):
+    state.streamed_runs.add(run_id)
+    _append_text(data["chunk"].content, state)
+
+
+def _handle_model_end(data: Dict[str, Any], name: str, run_id: str, state: _FlowState):
+    # Un acierto de caché no emite tokens: se usa el mensaje final completo
+    if run_id in state.streamed_runs:
+        state.streamed_runs.discard(run_id)
+        return
+    content = getattr(data.get("output"), "content", None)
+    if isinstance(content, str) and content:
+        _append_text(content, state)
+
+
+def _handle_tool_start(data: Dict[str, Any], name: str, run_id: str, state: _FlowState):
+    # Registro persistente de la herramienta
+    tool_data = {
+        "id": run_id[:8],
+        "name": name,
+        "input": data.get("input", {}),
+        "start_ns": time.perf_counter_ns(),
+        "output": None,
+        "status": "running",
+        "execution_time": None
+    }
+
+    state.tool_executions.append(tool_data)
+    # El inicio solo se anuncia con el toast; el área de herramientas se escribe
+    # una única vez por herramienta, al terminar
+    st.toast(f"Iniciando: {name}", icon="⚡")
+    state.running_tools[run_id] = tool_data
+
+
+def _handle_tool_end(data: Dict[str, Any], name: str, run_id: str, state: _FlowState):
+    # Actualización del estado de la herramienta
+    output = data.get("output", {})
+    error = data.get("error")
+
+    # Las herramientas de un mismo paso corren en paralelo: se empareja por run_id
+    tool_data = state.running_tools.pop(run_id, None)
+    if tool_data is not None:
+        tool_data["output"] = output
+        tool_data["status"] = "error" if error else "success"
+        tool_data["execution_time"] = (time.perf_counter_ns() - tool_data["start_ns"]) / 1e9
+
+    # Un único elemento por herramienta; el output completo solo se renderiza
+    # en el panel de supervisión (colapsado)
+    if error:
+        state.tools_area.error(f"❌ Error en herramienta:\n```\n{_truncate_text(error)}\n```")
+    else:
+        state.tools_area.success(f"✅ {name} ({_output_size(output)})")
+
+
+# Tabla de despacho: una sola búsqueda por evento devuelve el manejador y su peso
+_HANDLERS = {
+    "on_chain_start": (_handle_chain_start, 0.0),
+    "on_chat_model_stream": (_handle_stream, _PROGRESS_STREAM),
+    "on_chat_model_end": (_handle_model_end, 0.0),
+    "on_tool_start": (_handle_tool_start, _PROGRESS_TOOL_START),
+    "on_tool_end": (_handle_tool_end, _PROGRESS_TOOL_END)
+}
+
+
+async def _produce_events(research_stream, queue: asyncio.Queue):
+    """Drena el stream del grafo hacia la cola sin esperar al render."""
+    try:
+        async for event in research_stream:
+            await queue.put(event)
+    except Exception as e:
+        # El consumidor relanza el error en su propio contexto
+        await queue.put(e)
+        return
+    await queue.put(_STREAM_END)
+
+
 async def execute_research_flow(
     messages: list,
     placeholder: st.delta_generator.DeltaGenerator
@@ -50,17 +215,41 @@ async def execute_research_flow(
     Flujo principal de investigación con manejo robusto de errores.
     """
     supervisor = ResearchSupervisor()
-    final_text = ""
+    producer = None
+    # Visible para el botón "Detener Investigación" de app.py
+    st.session_state.research_supervisor = supervisor
+
+    # Importación diferida: construir el grafo (LLMs, validación de claves) solo cuando
+    # se lanza la primera investigación, no al cargar la app. Un fallo aquí es de
+    # configuración (p. ej. OPENAI_API_KEY ausente), no del flujo de investigación
+    try:
+        from graph import app_runnable
+    except RuntimeError as e:
+        logger.error(f"Error de configuración: {str(e)}")
+        placeholder.error(f"⚙️ Error de configuración: {str(e)}")
+        st.session_state.pop("research_supervisor", None)
+        return ""
     
     try:
-        # Inicialización del estado de herramientas
-        if "tool_executions" not in st.session_state:
-            st.session_state.tool_executions = []
-        
-        # Inicializa la barra de progreso
-        if "progress_bar" not in st.session_state:
-            st.session_state.progress_bar = placeholder.progress(0, text="🚀 Iniciando investigación...")
-            st.session_state.current_progress = 0.0
+        # Las claves de sesión ya vienen inicializadas desde app._ensure_session_defaults;
+        # la barra de progreso se crea por ejecución y se elimina en el finally
+        layout = placeholder.container()
+        st.session_state.progress_bar = layout.progress(0, text="🚀 Iniciando investigación...")
+        tools_area = layout.container()
+        text_slot = layout.empty()
+        st.session_state.current_progress = 0.0
+
+        # Referencias locales a los objetos de la sesión: se mutan in-place sin
+        # pasar por el proxy de st.session_state en cada evento
+        state = _FlowState(
+            text_slot,
+            tools_area,
+            st.session_state.tool_executions,
+            st.session_state.research_data
+        )
+        current_progress = st.session_state.current_progress
+        events_since_ui = 0
+        saturated = False
 
         # Inicia el stream asincrónico del grafo
         research_stream = app_runnable.astream_events(
@@ -69,80 +258,65 @@ async def execute_research_flow(
             config={"recursion_limit": 30}  # Aumentamos el límite de recursión
         )
         
-        async for event in research_stream:
+        # El productor recibe eventos mientras el consumidor hace las escrituras de UI
+        queue: asyncio.Queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        producer = asyncio.create_task(_produce_events(research_stream, queue))
+
+        while True:
+            event = await queue.get()
+            if event is _STREAM_END:
+                break
+            if isinstance(event, Exception):
+                raise event
             if supervisor._cancelled:
                 raise asyncio.CancelledError()
 
             event_type = event["event"]
+            entry = _HANDLERS.get(event_type)
+            if entry is None:
+                continue
+            handler, weight = entry
+
+            # Solo los tokens del nodo agente forman la respuesta visible; el resto de
+            # modelos del grafo (decisión, planificación, juez) no se renderizan
+            if (handler is _handle_stream or handler is _handle_model_end) and \
+                    event.get("metadata", {}).get("langgraph_node") != _ANSWER_NODE:
+                continue
 
-            # Manejo de ciclos de investigación
-            if event_type == "on_chain_start" and event["name"] == "planning":
-                st.session_state.research_data["current_cycle"] += 1
-                logger.debug(f"Ciclo de investigación #{st.session_state.research_data['current_cycle']}")
-                
-                if st.session_state.research_data["current_cycle"] > st.session_state.research_data["max_cycles"]:
-                    raise RuntimeError("🔬 Límite máximo de ciclos alcanzado. Revisa los parámetros de búsqueda.")
-            
             # Actualización de progreso dinámico
-            progress_weights = {
-                "on_tool_start": 0.1,
-                "on_tool_end": 0.2,
-                "on_chat_model_stream": 0.05
-            }
-            st.session_state.current_progress = min(
-                st.session_state.current_progress + progress_weights.get(event_type, 0),
-                0.95
-            )
+            current_progress = min(current_progress + weight, _PROGRESS_CAP)
             
-            supervisor.update_progress(
-                st.session_state.current_progress,
-                "🔍 Analizando información..."
-            )
+            # Los tokens del stream no actualizan la barra; el resto de eventos
+            # la actualiza cada UI_EVENT_BUDGET eventos y siempre al cerrar una herramienta.
+            # Una vez enviada la barra saturada no hay más cambios visibles hasta el final.
+            events_since_ui += 1
+            if not saturated and (event_type == "on_tool_end" or (
+                event_type != "on_chat_model_stream" and events_since_ui >= UI_EVENT_BUDGET
+            )):
+                events_since_ui = 0
+                supervisor.update_progress(
+                    current_progress,
+                    "🔍 Analizando información..."
+                )
+                saturated = current_progress >= _PROGRESS_CAP
 
             # Procesamiento de eventos relevantes
-            if event_type == "on_chat_model_stream":
-                final_text += event["data"]["chunk"].content
-                placeholder.markdown(f"```markdown\n{final_text}\n```")
-
-            elif event_type == "on_tool_start":
-                # Registro persistente de la herramienta
-                tool_data = {
-                    "id": event["run_id"][:8],
-                    "name": event["name"],
-                    "input": event["data"].get("input", {}),
-                    "start_time": time.time(),
-                    "output": None,
-                    "status": "running",
-                    "execution_time": None
-                }
-                
-                st.session_state.tool_executions.append(tool_data)
-                st.toast(f"Iniciando: {tool_data['name']}", icon="⚡")
-
-            elif event_type == "on_tool_end":
-                # Actualización del estado de la herramienta
-                output = event["data"].get("output", {})
-                error = event["data"].get("error")
-                
-                if st.session_state.tool_executions:
-                    last_tool = st.session_state.tool_executions[-1]
-                    last_tool["output"] = output
-                    last_tool["status"] = "error" if error else "success"
-                    last_tool["execution_time"] = time.time() - last_tool["start_time"]
-                
-                with placeholder.container():
-                    if error:
-                        st.error(f"❌ Error en herramienta:\n```\n{str(error)[:500]}\n```")
-                    else:
-                        st.success("✅ Resultado obtenido")
-                        st.json(output, expanded=False)
+            handler(event["data"], event.get("name"), event.get("run_id"), state)
+
+        # Último fragmento pendiente del stream
+        if state.pending_chars:
+            text_slot.markdown(f"```markdown\n{''.join(state.final_chunks)}\n```")
+
+        if not saturated:
+            supervisor.update_progress(current_progress, "🔍 Analizando información...")
+        st.session_state.current_progress = current_progress
 
     except asyncio.CancelledError:
         logger.warning("Investigación cancelada por el usuario")
         placeholder.warning("⏹️ Investigación detenida a petición del usuario")
         return "Operación cancelada"
     
-    except RuntimeError as e:
+    except CycleLimitError as e:
         logger.error(f"Límite de ciclos alcanzado: {str(e)}")
         placeholder.error(f"⚠️ {str(e)}")
         return "Límite máximo de iteraciones alcanzado"
@@ -153,6 +327,9 @@ async def execute_research_flow(
         return "Error en el proceso"
     
     finally:
+        st.session_state.pop("research_supervisor", None)
+        if producer and not producer.done():
+            producer.cancel()
         try:
             supervisor.update_progress(1.0, "🏁 Proceso completado")
             await asyncio.sleep(0.5)
@@ -164,4 +341,4 @@ async def execute_research_flow(
         except Exception as e:
             logger.error(f"Error en limpieza: {str(e)}")
 
-    return final_text
\ No newline at end of file
+    return "".join(state.final_chunks)
\ No newline at end of file
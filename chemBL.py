@@ -1,47 +1,103 @@
+import urllib.parse
 import streamlit as st
 import requests
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Sesión compartida: reutiliza conexiones TCP/TLS hacia ebi.ac.uk entre búsquedas
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504))
+)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({"Content-Type": "application/json", "Accept-Encoding": "gzip"})
+
+# Plantillas de URL de ChEMBL (formato JSON); solo varía el valor consultado
+_API_BASE = "https://www.ebi.ac.uk/chembl/api/data"
+_MOLECULE_URLS = {
+    "name": _API_BASE + "/molecule.json?pref_name__icontains={}&format=json",
+    "cas": _API_BASE + "/molecule.json?molecule_synonyms__synonyms__iexact={}&format=json",
+    "smiles": _API_BASE + "/molecule.json?substructure={}&format=json"
+}
+_DRUG_URL = _API_BASE + "/drug?molecule_chembl_id={}&format=json"
+_MECHANISM_URL = _API_BASE + "/mechanism?molecule_chembl_id={}&format=json"
+_INDICATION_URL = _API_BASE + "/drug_indication?molecule_chembl_id={}&format=json"
+
+# Las respuestas de ChEMBL cambian con poca frecuencia: se cachean 24 h entre reruns
+_CACHE_TTL = 24 * 3600
+
+@st.cache_data(ttl=_CACHE_TTL, show_spinner=False)
+def _fetch_molecules(url):
+    """GET cacheado por URL; los errores se propagan y no quedan en caché."""
+    response = SESSION.get(url, timeout=10)
+    response.raise_for_status()
+    return response.json() if response.text.strip() else None
 
 def get_chembl_data(query_type, query):
     """Fetches data from ChEMBL API based on query type and value."""
-    base_url = "https://www.ebi.ac.uk/chembl/api/data/molecule.json"  # Ensure JSON format
-    if query_type == "name":
-        url = f"{base_url}?pref_name__icontains={query}&format=json"
-    elif query_type == "cas":
-        url = f"{base_url}?molecule_synonyms__synonyms__iexact={query}&format=json"
-    elif query_type == "smiles":
-        url = f"{base_url}?substructure={query}&format=json"
-    else:
+    template = _MOLECULE_URLS.get(query_type)
+    # Normaliza la consulta para aumentar los aciertos de caché (SMILES distingue mayúsculas)
+    query = query.strip()
+    if template is None or not query:
         return None
+    if query_type != "smiles":
+        query = query.lower()
+    # quote codifica '+', '/', '#', '=' y espacios presentes en CAS/SMILES
+    url = template.format(urllib.parse.quote(query, safe=""))
 
     try:
-        response = requests.get(url, headers={"Content-Type": "application/json"})
-        response.raise_for_status()
-        return response.json() if response.text.strip() else None
+        return _fetch_molecules(url)
     except requests.exceptions.RequestException as e:
         st.error(f"Error al realizar la solicitud al API: {e}")
         return None
 
+# Hilos para consultar los endpoints de drogas en paralelo sobre la sesión compartida
+# (conserva el pool de conexiones y la política de reintentos)
+_DRUG_EXECUTOR = ThreadPoolExecutor(max_workers=3, thread_name_prefix="chembl")
+
+class _PartialDrugData(Exception):
+    """Algún endpoint falló; lleva los resultados que sí se obtuvieron."""
+    def __init__(self, results, errors):
+        super().__init__("; ".join(str(e) for e in errors))
+        self.results = results
+
+def _get_json(url):
+    """GET a un endpoint de ChEMBL; retorna el JSON si la respuesta es 200, si no None."""
+    response = SESSION.get(url, timeout=10)
+    # Los errores del servidor se propagan para no cachear una respuesta transitoria
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response.json() if response.status_code == 200 else None
+
+@st.cache_data(ttl=_CACHE_TTL, show_spinner=False)
+def _fetch_drug_data(chembl_id):
+    """Consulta concurrentemente los endpoints de drogas, mecanismos e indicaciones."""
+    urls = (_DRUG_URL.format(chembl_id), _MECHANISM_URL.format(chembl_id), _INDICATION_URL.format(chembl_id))
+    futures = [_DRUG_EXECUTOR.submit(_get_json, url) for url in urls]
+
+    results, errors = [], []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except (requests.exceptions.RequestException, ValueError) as e:
+            results.append(None)
+            errors.append(e)
+    # Un fallo parcial no se cachea, pero los demás resultados se conservan
+    if errors:
+        raise _PartialDrugData(tuple(results), errors)
+    return tuple(results)
+
 def get_drug_data(chembl_id):
     """Fetches drug data (market status, mechanism of action, indications) from ChEMBL."""
     try:
-        # Fetch approved drugs information
-        drug_url = f"https://www.ebi.ac.uk/chembl/api/data/drug?molecule_chembl_id={chembl_id}&format=json"
-        mechanism_url = f"https://www.ebi.ac.uk/chembl/api/data/mechanism?molecule_chembl_id={chembl_id}&format=json"
-        indication_url = f"https://www.ebi.ac.uk/chembl/api/data/drug_indication?molecule_chembl_id={chembl_id}&format=json"
-
-        drug_response = requests.get(drug_url, headers={"Content-Type": "application/json"})
-        mechanism_response = requests.get(mechanism_url, headers={"Content-Type": "application/json"})
-        indication_response = requests.get(indication_url, headers={"Content-Type": "application/json"})
-
-        drug_data = drug_response.json() if drug_response.status_code == 200 else None
-        mechanism_data = mechanism_response.json() if mechanism_response.status_code == 200 else None
-        indication_data = indication_response.json() if indication_response.status_code == 200 else None
-
-        return drug_data, mechanism_data, indication_data
-    except requests.exceptions.RequestException as e:
+        return _fetch_drug_data(chembl_id)
+    except _PartialDrugData as e:
         st.error(f"Error al realizar la solicitud al API para datos de drogas: {e}")
-        return None, None, None
+        return e.results
 
 def generate_report(chembl_id, molecular_properties, drug_data, mechanism_data, indication_data):
     """Generates a nicely formatted report for the results."""
@@ -57,26 +113,32 @@ def generate_report(chembl_id, molecular_properties, drug_data, mechanism_data,
     if drug_data and "drugs" in drug_data:
         report.append("## Drogas en el Mercado\n")
         for drug in drug_data["drugs"]:
-            report.append(f"- **Nombre Comercial:** {drug.get('trade_name', 'N/A')}\n")
-            report.append(f"  - **Fabricante:** {', '.join(drug.get('applicants', ['N/A']))}\n")
-            report.append(f"  - **ATC Classification:** {', '.join([atc.get('description', 'N/A') for atc in drug.get('atc_classification', [])])}\n")
-            report.append(f"  - **Indicación:** {drug.get('indication_class', 'N/A')}\n")
-            report.append(f"  - **Estado de Aprobación:** {drug.get('approval_status', 'N/A')}\n")
+            g = drug.get
+            atc_desc = ", ".join(atc.get("description", "N/A") for atc in g("atc_classification", ()))
+            report.append(f"- **Nombre Comercial:** {g('trade_name', 'N/A')}\n")
+            report.append(f"  - **Fabricante:** {', '.join(g('applicants', ('N/A',)))}\n")
+            report.append(f"  - **ATC Classification:** {atc_desc}\n")
+            report.append(f"  - **Indicación:** {g('indication_class', 'N/A')}\n")
+            report.append(f"  - **Estado de Aprobación:** {g('approval_status', 'N/A')}\n")
 
     if mechanism_data and "mechanisms" in mechanism_data:
         report.append("## Mecanismos de Acción\n")
         for mechanism in mechanism_data["mechanisms"]:
-            report.append(f"- **Mecanismo de Acción:** {mechanism.get('mechanism_of_action', 'N/A')}\n")
-            report.append(f"  - **Objetivo:** {mechanism.get('target_name', 'N/A')}\n")
+            g = mechanism.get
+            report.append(f"- **Mecanismo de Acción:** {g('mechanism_of_action', 'N/A')}\n")
+            report.append(f"  - **Objetivo:** {g('target_name', 'N/A')}\n")
 
     if indication_data and "drug_indications" in indication_data:
         report.append("## Indicaciones Terapéuticas\n")
         for indication in indication_data["drug_indications"]:
-            report.append(f"- **Término EFO:** {indication.get('efo_term', 'N/A')}\n")
-            report.append(f"  - **MESH Heading:** {indication.get('mesh_heading', 'N/A')}\n")
+            g = indication.get
+            report.append(f"- **Término EFO:** {g('efo_term', 'N/A')}\n")
+            report.append(f"  - **MESH Heading:** {g('mesh_heading', 'N/A')}\n")
             if "indication_refs" in indication:
-                refs = [f"[{ref.get('ref_id', 'N/A')}]({ref.get('ref_url', '#')})" for ref in indication["indication_refs"]]
-                report.append(f"  - **Referencias:** {', '.join(refs)}\n")
+                refs = ", ".join(
+                    f"[{ref.get('ref_id', 'N/A')}]({ref.get('ref_url', '#')})" for ref in indication["indication_refs"]
+                )
+                report.append(f"  - **Referencias:** {refs}\n")
 
     return "\n".join(report)
 
@@ -1,32 +1,94 @@
 from langchain_openai import ChatOpenAI
 from langgraph.graph import END, StateGraph
-from langchain_core.messages import BaseMessage, SystemMessage, ToolMessage, AIMessage
+from langchain_core.messages import SystemMessage, ToolMessage, AIMessage, HumanMessage
 from langchain_core.runnables import RunnableConfig, Runnable
+from langchain_core.globals import set_llm_cache
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_core.exceptions import OutputParserException
+from pydantic import ValidationError
+import openai
+import asyncio
 import logging
+import re
 import os
 import json
-from typing import Dict, Any, Callable
+from functools import cached_property, lru_cache
+from typing import Dict, Any, Callable, Optional
 
-from state import AgentState, DecisionMakingOutput, JudgeOutput, validate_messages, validate_state_consistency
+from state import AgentState, DecisionAndPlanOutput, JudgeOutput, validate_messages
 from agent_tools import tools
+from llm_cache import LLMCache
 from utils import (
-    decision_making_prompt,
+    decision_and_planning_prompt,
     planning_prompt,
     format_tools_description,
     agent_prompt,
-    judge_prompt
+    judge_prompt,
+    invoke_with_validation_retry,
+    compact_messages,
+    current_date
 )
 
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+except ImportError:  # orjson es opcional; json de la stdlib como respaldo
+    _dumps = json.dumps
+
 logger = logging.getLogger(__name__)
 
+# Casos inequívocos que el juez resuelve sin llamar al LLM: por debajo de
+# _JUDGE_TOO_SHORT_CHARS se rechaza; con citas y más de _JUDGE_MIN_ANSWER_CHARS se
+# acepta. Lo intermedio lo evalúa el LLM
+_JUDGE_TOO_SHORT_CHARS = 50
+_JUDGE_MIN_ANSWER_CHARS = 200
+_TRIVIAL_ANSWER_RE = re.compile(r"^\s*(lo siento|i cannot|no tengo)", re.IGNORECASE)
+_CITATION_RE = re.compile(r"\[\d+\]|doi\.org|arxiv", re.IGNORECASE)
+_ERROR_RE = re.compile(r"\berror\b", re.IGNORECASE)
+
+# Respuesta del agente cuando falla la llamada al LLM; el juez la acepta tal cual
+# porque revisarla no la mejora
+_AGENT_ERROR_MESSAGE = "Error interno. Intenta nuevamente."
+
+# Fallos esperables de una llamada con salida estructurada: errores de la API de OpenAI
+# (incluido un 400 por esquema inválido) y salidas que no validan tras los reintentos
+_STRUCTURED_LLM_ERRORS = (openai.APIError, ValidationError, OutputParserException, ValueError)
+
+# Máximo de herramientas ejecutándose a la vez dentro de un paso
+_MAX_TOOL_CONCURRENCY = 8
+
+# Borradores del asistente más largos que esto no se reenvían al replanificar
+_MAX_DRAFT_CHARS = 2000
+
+# Descripción e índice de herramientas calculados una vez al importar
+_TOOLS_DESC = format_tools_description(tools)
+_TOOLS_MAP = {tool.name: tool for tool in tools}
+# Esquemas JSON de las herramientas serializados una vez; bind_tools los acepta tal cual
+_TOOL_SCHEMAS = [convert_to_openai_tool(tool) for tool in tools]
+
 class GraphConfiguration:
     """Manejador centralizado de configuración del grafo"""
     def __init__(self):
         self.llm_model = "gpt-4o-mini"
+        # Modelo por nodo: clasificación y rúbrica van al modelo económico; el agente
+        # puede usar uno más capaz (AGENT_MODEL, p. ej. gpt-4o)
+        self.decision_model = os.getenv("DECISION_MODEL", "gpt-4o-mini")
+        self.judge_model = os.getenv("JUDGE_MODEL", "gpt-4o-mini")
+        self.agent_model = os.getenv("AGENT_MODEL", self.llm_model)
         self.llm_temperature = 0
+        # Clave estable de caché de prompts: los system prompts de los nodos son
+        # prefijos fijos y OpenAI reutiliza los >=1024 tokens iniciales
+        self.prompt_cache_key = os.getenv("PROMPT_CACHE_KEY", "sci-agent-v1")
         self.max_research_cycles = 3
         self.max_feedback_attempts = 2
+        # Umbral de tokens del historial a partir del cual se resumen las rondas de herramientas;
+        # cercano a la ventana de 128k de gpt-4o/gpt-4o-mini, con margen para prompt y respuesta
+        self.max_history_tokens = int(os.getenv("MAX_HISTORY_TOKENS", "100000"))
+        self._llms: Dict[str, ChatOpenAI] = {}
         self._validate_environment()
+        self._configure_llm_cache()
 
     def _validate_environment(self):
         """Valida dependencias externas"""
@@ -35,34 +97,74 @@ class GraphConfiguration:
         if not os.getenv("CORE_API_KEY"):
             logger.warning("CORE_API_KEY no encontrada - funcionalidad limitada")
 
-    def initialize_llms(self) -> ChatOpenAI:
-        """Factory para modelos de lenguaje"""
-        return ChatOpenAI(
-            model=self.llm_model,
-            temperature=self.llm_temperature,
-            #model_kwargs={"response_format": {"type": "json_object"}}
+    def _configure_llm_cache(self):
+        """Activa la caché de respuestas del LLM si LLM_CACHE_DIR está definida"""
+        cache_dir = os.getenv("LLM_CACHE_DIR")
+        if cache_dir:
+            set_llm_cache(LLMCache(cache_dir))
+            logger.info(f"Caché LLM activa en {cache_dir}")
+
+    def initialize_llms(self, model: Optional[str] = None) -> ChatOpenAI:
+        """
+        Cliente LLM compartido por modelo (un solo pool de conexiones por modelo).
+
+        Los nodos lo usan solo de forma síncrona (asyncio.to_thread(llm.invoke, ...)):
+        cada sesión de Streamlit tiene su propio event loop y el cliente async de
+        OpenAI no puede compartir conexiones entre loops.
+        """
+        model = model or self.llm_model
+        if model not in self._llms:
+            self._llms[model] = ChatOpenAI(
+                model=model,
+                temperature=self.llm_temperature,
+                model_kwargs={"prompt_cache_key": self.prompt_cache_key},
+                #model_kwargs={"response_format": {"type": "json_object"}}
+            )
+        return self._llms[model]
+
+    @cached_property
+    def llm_with_tools(self) -> Runnable:
+        """Cliente del agente con las herramientas enlazadas (se construye una sola vez)"""
+        return self.initialize_llms(self.agent_model).bind_tools(_TOOL_SCHEMAS)
+
+    def structured_llm(self, schema: type, model: Optional[str] = None):
+        """Cliente compartido con salida estructurada nativa (response_format=json_schema)"""
+        # Decodificación restringida en el servidor: el JSON siempre cumple el esquema,
+        # sin la herramienta auxiliar de function-calling
+        # include_raw: los errores de validación se retornan junto a la salida cruda para
+        # reenviarla al modelo en el reintento (invoke_with_validation_retry)
+        return self.initialize_llms(model).with_structured_output(
+            schema, method="json_schema", strict=True, include_raw=True
         )
 
 def setup_decision_making_node(config: GraphConfiguration) -> Callable[[AgentState], Dict[str, Any]]:
-    """Nodo de decisión inicial: Determina si se requiere investigación"""
-    llm = config.initialize_llms()
+    """Nodo de decisión inicial: Determina si se requiere investigación y, si es así, planifica"""
+    llm = config.structured_llm(DecisionAndPlanOutput, config.decision_model)
+    # Una sola llamada cubre decisión y plan: la rama de investigación no espera a 'planning'.
+    # El mensaje de sistema se reconstruye solo cuando cambia el día
+    @lru_cache(maxsize=1)
+    def _system_msg(day: str) -> SystemMessage:
+        return SystemMessage(content=decision_and_planning_prompt.format(
+            tools=_TOOLS_DESC, max_steps=config.max_research_cycles, current_date=day
+        ))
     
-    def _node_logic(state: AgentState) -> Dict[str, Any]:
+    async def _node_logic(state: AgentState) -> Dict[str, Any]:
         try:
             validate_messages(state["messages"])
-            system_msg = SystemMessage(content=decision_making_prompt)
-            response = llm.with_structured_output(DecisionMakingOutput).invoke(
-                [system_msg] + state["messages"]
-            )
+            response = await invoke_with_validation_retry(llm, [_system_msg(current_date())] + state["messages"])
             
             logger.info(f"Decisión: {'investigar' if response.requires_research else 'responder'}")
             
+            if response.requires_research:
+                logger.info("Plan generado", extra={"plan": response.plan})
+                return {"requires_research": True, "messages": [AIMessage(content=response.plan)]}
+
             return {
-                "requires_research": response.requires_research,
-                "messages": [AIMessage(content=response.answer)] if response.answer else []
+                "requires_research": False,
+                "messages": [AIMessage(content=response.answer)]
             }
-        except Exception as e:
-            logger.error(f"Error en decisión: {str(e)}")
+        except _STRUCTURED_LLM_ERRORS:
+            logger.exception("Error en decisión: se planifica por separado")
             return {"requires_research": True, "messages": []}
 
     return _node_logic
@@ -70,13 +172,28 @@ def setup_decision_making_node(config: GraphConfiguration) -> Callable[[AgentSta
 def setup_planning_node(config: GraphConfiguration) -> Callable[[AgentState], Dict[str, Any]]:
     """Nodo de planificación: Genera estrategia de investigación"""
     llm = config.initialize_llms()
+    # El conjunto de herramientas no cambia: el prompt se construye una sola vez
+    system_msg = SystemMessage(
+        content=planning_prompt.format(tools=_TOOLS_DESC, max_steps=config.max_research_cycles)
+    )
     
-    def _node_logic(state: AgentState) -> Dict[str, Any]:
+    async def _node_logic(state: AgentState) -> Dict[str, Any]:
         try:
-            tools_desc = format_tools_description(tools)
-            prompt = planning_prompt.format(tools=tools_desc, max_steps=config.max_research_cycles)
-            system_msg = SystemMessage(content=prompt)
-            response = llm.invoke([system_msg] + state["messages"])
+            # Al volver desde el juez, los borradores rechazados del turno actual (posteriores
+            # al último HumanMessage) no se reenvían completos: basta con el feedback compacto.
+            # Las respuestas aceptadas de turnos anteriores y los mensajes con tool_calls
+            # se conservan
+            history = state["messages"]
+            turn_start = next(
+                (i for i in range(len(history) - 1, -1, -1) if isinstance(history[i], HumanMessage)),
+                0
+            )
+            messages = history[:turn_start] + [
+                m for m in history[turn_start:]
+                if not (isinstance(m, AIMessage) and not m.tool_calls
+                        and len(m.content) > _MAX_DRAFT_CHARS)
+            ]
+            response = await asyncio.to_thread(llm.invoke, [system_msg] + messages)
             
             logger.info("Plan generado", extra={"plan": response.content})
             
@@ -89,29 +206,47 @@ def setup_planning_node(config: GraphConfiguration) -> Callable[[AgentState], Di
 
 def setup_tools_node() -> Callable[[AgentState], Dict[str, Any]]:
     """Ejecutor de herramientas: Maneja llamados a APIs externas"""
-    tools_map = {tool.name: tool for tool in tools}
-    
-    def _node_logic(state: AgentState) -> Dict[str, Any]:
+    async def _run_tool(tool_call: Dict[str, Any], semaphore: asyncio.Semaphore) -> ToolMessage:
+        tool = _TOOLS_MAP.get(tool_call["name"])
+        if not tool:
+            raise KeyError(f"Herramienta {tool_call['name']} no registrada")
+        
+        async with semaphore:
+            result = await tool.ainvoke(tool_call["args"])
+        logger.info("Ejecución exitosa", extra={"tool": tool_call["name"]})
+        # Los resultados de texto se pasan tal cual, sin re-serializar
+        return ToolMessage(
+            content=result if isinstance(result, str) else _dumps(result),
+            name=tool_call["name"],
+            tool_call_id=tool_call["id"],
+        )
+
+    async def _node_logic(state: AgentState) -> Dict[str, Any]:
         try:
-            last_msg = state["messages"][-1]
-            outputs = []
-            
-            for tool_call in last_msg.tool_calls:
-                tool = tools_map[tool_call["name"]]
-                if not tool:
-                    raise KeyError(f"Herramienta {tool_call['name']} no registrada")
-                
-                result = tool.invoke(tool_call["args"])
-                outputs.append(
-                    ToolMessage(
-                        content=json.dumps(result),
+            tool_calls = state["messages"][-1].tool_calls
+            # Las llamadas emitidas en un mismo paso se ejecutan concurrentemente,
+            # acotadas para respetar los límites de las APIs. El semáforo se crea por
+            # invocación: cada sesión de Streamlit usa su propio event loop
+            semaphore = asyncio.Semaphore(_MAX_TOOL_CONCURRENCY)
+            outputs = await asyncio.gather(
+                *(_run_tool(tool_call, semaphore) for tool_call in tool_calls),
+                return_exceptions=True
+            )
+
+            # Un fallo aislado no descarta el resto: cada tool_call recibe su ToolMessage
+            messages = []
+            for tool_call, output in zip(tool_calls, outputs):
+                if isinstance(output, Exception):
+                    logger.error(f"Error en herramienta {tool_call['name']}: {str(output)}")
+                    output = ToolMessage(
+                        content=f"Error ejecutando herramienta: {str(output)}",
                         name=tool_call["name"],
                         tool_call_id=tool_call["id"],
+                        status="error",
                     )
-                )
-                logger.info("Ejecución exitosa", extra={"tool": tool_call["name"]})
+                messages.append(output)
             
-            return {"messages": outputs}
+            return {"messages": messages}
         except Exception as e:
             logger.error(f"Error en herramientas: {str(e)}")
             return {"messages": [AIMessage(content=f"Error ejecutando herramienta: {str(e)}")]}
@@ -120,13 +255,23 @@ def setup_tools_node() -> Callable[[AgentState], Dict[str, Any]]:
 
 def setup_agent_node(config: GraphConfiguration) -> Callable[[AgentState], Dict[str, Any]]:
     """Nodo principal del agente: Genera respuestas usando LLM"""
-    llm = config.initialize_llms().bind_tools(tools)
+    summarizer = config.initialize_llms()
+    llm = config.llm_with_tools
+    system_msg = SystemMessage(content=agent_prompt)
     
-    def _node_logic(state: AgentState) -> Dict[str, Any]:
+    async def _node_logic(state: AgentState) -> Dict[str, Any]:
         try:
-            system_msg = SystemMessage(content=agent_prompt)
-            response = llm.invoke(
-                [system_msg] + state["messages"],
+            # Las rondas de herramientas antiguas se resumen solo para esta llamada;
+            # el estado conserva el historial completo
+            messages = await asyncio.to_thread(
+                compact_messages, state["messages"], summarizer,
+                config.agent_model, config.max_history_tokens
+            )
+            # Con astream_events activo, invoke emite los tokens a medida que llegan
+            # (on_chat_model_stream) y retorna el AIMessage ya concatenado
+            response = await asyncio.to_thread(
+                llm.invoke,
+                [system_msg] + messages,
                 config=RunnableConfig(metadata={
                     "research_cycle": state.get("research_cycles", 0) + 1
                 })
@@ -134,24 +279,47 @@ def setup_agent_node(config: GraphConfiguration) -> Callable[[AgentState], Dict[
             return {"messages": [response]}
         except Exception as e:
             logger.error(f"Error en agente: {str(e)}")
-            return {"messages": [AIMessage(content="Error interno. Intenta nuevamente.")]}
+            return {"messages": [AIMessage(content=_AGENT_ERROR_MESSAGE)]}
 
     return _node_logic
 
 def setup_judge_node(config: GraphConfiguration) -> Callable[[AgentState], Dict[str, Any]]:
     """Nodo de evaluación: Control de calidad de respuestas"""
-    llm = config.initialize_llms()
+    summarizer = config.initialize_llms()
+    llm = config.structured_llm(JudgeOutput, config.judge_model)
+    system_msg = SystemMessage(content=judge_prompt)
     
-    def _node_logic(state: AgentState) -> Dict[str, Any]:
+    async def _node_logic(state: AgentState) -> Dict[str, Any]:
         try:
             if state.get("num_feedback_requests", 0) >= config.max_feedback_attempts:
                 logger.warning("Límite de feedback alcanzado")
                 return {"is_good_answer": True}
 
-            system_msg = SystemMessage(content=judge_prompt)
-            response = llm.with_structured_output(JudgeOutput).invoke(
-                [system_msg] + state["messages"]
+            content = state["messages"][-1].content
+            if isinstance(content, str):
+                if content == _AGENT_ERROR_MESSAGE:
+                    logger.warning("El agente falló: se entrega el error sin pedir revisión")
+                    return {"is_good_answer": True}
+                if _TRIVIAL_ANSWER_RE.match(content):
+                    logger.info("Respuesta trivial: se omite la evaluación del juez")
+                    return {"is_good_answer": True}
+                if len(content) < _JUDGE_TOO_SHORT_CHARS:
+                    logger.info("Respuesta demasiado corta: se rechaza sin evaluar")
+                    return {
+                        "is_good_answer": False,
+                        "num_feedback_requests": state.get("num_feedback_requests", 0) + 1,
+                        "messages": [AIMessage(content="FEEDBACK:\nResponse too short")]
+                    }
+                if (len(content) > _JUDGE_MIN_ANSWER_CHARS and _CITATION_RE.search(content)
+                        and not _ERROR_RE.search(content)):
+                    logger.info("Respuesta con citas: se acepta sin evaluar")
+                    return {"is_good_answer": True}
+
+            messages = await asyncio.to_thread(
+                compact_messages, state["messages"], summarizer,
+                config.judge_model, config.max_history_tokens
             )
+            response = await invoke_with_validation_retry(llm, [system_msg] + messages)
             
             output = {
                 "is_good_answer": response.is_good_answer,
@@ -159,12 +327,11 @@ def setup_judge_node(config: GraphConfiguration) -> Callable[[AgentState], Dict[
             }
             
             if response.feedback:
-                output["messages"] = [AIMessage(content=response.feedback)]
+                output["messages"] = [AIMessage(content=f"FEEDBACK:\n{response.feedback}")]
             
-            validate_state_consistency(output)
             return output
-        except Exception as e:
-            logger.error(f"Error en evaluación: {str(e)}")
+        except _STRUCTURED_LLM_ERRORS:
+            logger.exception("Error en evaluación: se acepta la respuesta sin revisar")
             return {"is_good_answer": True}
 
     return _node_logic
@@ -190,7 +357,11 @@ def create_workflow() -> Runnable:
 
     def router(state: AgentState):
         """Router directing the user query"""
-        return "planning" if state["requires_research"] else "end"
+        if not state["requires_research"]:
+            return "end"
+        # Si la decisión ya incluyó el plan se pasa directo al agente; si falló
+        # (último mensaje del usuario) se planifica por separado
+        return "agent" if isinstance(state["messages"][-1], AIMessage) else "planning"
     
     # Final answer router function
     def final_answer_router(state: AgentState):
@@ -220,6 +391,7 @@ def create_workflow() -> Runnable:
         "decision_making",
         router,
         {
+            "agent": "agent",
             "planning": "planning",
             "end": END,
         }
@@ -0,0 +1,118 @@
+# llm_cache.py
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional
+
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+class LLMCache(BaseCache):
+    """
+    Caché de respuestas del LLM direccionada por contenido.
+
+    La clave es el SHA-256 del prompt serializado (system prompt + mensajes) y del
+    llm_string de LangChain, que incluye modelo, temperatura, herramientas enlazadas
+    y esquema de salida estructurada. Mantiene un LRU en memoria con TTL y persiste
+    cada entrada como JSON en disco.
+    """
+    def __init__(self, cache_dir: str, maxsize: int = 256, ttl: float = 24 * 3600):
+        self.cache_dir = Path(cache_dir)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _remember(self, key: str, created_at: float, value: RETURN_VAL_TYPE) -> None:
+        with self._lock:
+            self._memory[key] = (created_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def _evict(self, key: str) -> None:
+        with self._lock:
+            self._memory.pop(key, None)
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        """Retorna las generaciones cacheadas si existen y no han expirado."""
+        key = self._key(prompt, llm_string)
+        now = time.time()
+
+        with self._lock:
+            hit = self._memory.get(key)
+            if hit is not None:
+                self._memory.move_to_end(key)
+        if hit is not None:
+            created_at, value = hit
+            if now - created_at < self.ttl:
+                return value
+            self._evict(key)
+            return None
+
+        try:
+            entry = json.loads(self._path(key).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+        if now - entry.get("created_at", 0) >= self.ttl:
+            self._evict(key)
+            return None
+
+        try:
+            value = loads(entry["generations"])
+        except Exception as e:
+            # Entradas corruptas o de una versión incompatible se descartan
+            logger.warning(f"Entrada de caché LLM inválida, se elimina: {str(e)}")
+            self._evict(key)
+            return None
+
+        self._remember(key, entry["created_at"], value)
+        return value
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        """Guarda las generaciones en memoria y en disco (escritura atómica)."""
+        key = self._key(prompt, llm_string)
+        created_at = time.time()
+        self._remember(key, created_at, return_val)
+
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(
+                json.dumps({"created_at": created_at, "generations": dumps(return_val)}),
+                encoding="utf-8"
+            )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"No se pudo escribir la caché LLM: {str(e)}")
+
+    def clear(self, **kwargs: Any) -> None:
+        """Vacía la caché en memoria y en disco."""
+        with self._lock:
+            self._memory.clear()
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
@@ -3,8 +3,8 @@ from pydantic import (
     BaseModel,
     Field,
     ValidationError,
-    model_validator,
-    ConfigDict,
+    ValidationInfo,
+    BeforeValidator,
     field_validator
 )
 from datetime import datetime
@@ -27,8 +27,6 @@ class AgentState(TypedDict):
     research_cycles: int
     created_at: datetime
     last_updated: datetime
-    # Añadir valores por defecto
-    model_config = ConfigDict(extra="allow")
 
 def validate_messages(messages: List[BaseMessage]) -> None:
     if not messages:
@@ -36,15 +34,14 @@ def validate_messages(messages: List[BaseMessage]) -> None:
     if not isinstance(messages[-1], (AIMessage, HumanMessage)):
         raise ValueError("Último mensaje debe ser del usuario o asistente")
 
-def validate_state_consistency(state: AgentState) -> None:
-    if state["is_good_answer"] and state["requires_research"]:
-        raise ValueError("Estado inconsistente: respuesta buena pero requiere investigación")
-    if state["num_feedback_requests"] > 0 and not state["requires_research"]:
-        raise ValueError("Feedback solicitado sin investigación requerida")
+def _sanitize_query(value):
+    """Sanitiza la consulta de búsqueda"""
+    return value.strip().replace('"', '') if isinstance(value, str) else value
 
 class SearchPapersInput(BaseModel):
     """Input validado para búsquedas en CORE API"""
-    query: str = Field(
+    # La limpieza corre antes de las restricciones de longitud, que valida pydantic-core
+    query: Annotated[str, BeforeValidator(_sanitize_query)] = Field(
         ...,
         min_length=3,
         max_length=200,
@@ -58,33 +55,52 @@ class SearchPapersInput(BaseModel):
         description="Número máximo de papers a retornar",
     )
 
-    @field_validator('query')
-    @classmethod
-    def sanitize_query(cls, value: str) -> str:
-        """Sanitiza la consulta de búsqueda"""
-        cleaned = value.strip().replace('"', '')
-        if len(cleaned) < 3:
-            raise ValueError("La consulta debe tener al menos 3 caracteres")
-        return cleaned
-
-class DecisionMakingOutput(BaseModel):
-    """Output estructurado del nodo de toma de decisiones inicial"""
+class DownloadPaperInput(BaseModel):
+    """Input validado para la descarga de papers"""
+    url: str = Field(
+        ...,
+        description="URL válida de un documento PDF",
+    )
+
+    mode: Literal["text", "metadata"] = Field(
+        default="text",
+        description="'metadata' retorna título/autores/abstract de una búsqueda previa sin descargar el PDF; 'text' extrae el texto completo",
+    )
+
+# Salidas estructuradas estrictas (json_schema, strict=True): OpenAI exige que todas
+# las propiedades estén en "required", así que los campos opcionales son obligatorios
+# y anulables (Optional[...] = Field(...)) en lugar de tener un valor por defecto
+
+class DecisionAndPlanOutput(BaseModel):
+    """Output estructurado del nodo de decisión fusionado con la planificación"""
     requires_research: bool = Field(
         ...,
         description="Indica si la consulta requiere investigación adicional"
     )
-    
-    # Eliminamos min_length y max_length para evitar invalid schema en openai
+
     answer: Optional[str] = Field(
-        default=None,
+        ...,
         description="Respuesta directa si no se requiere investigación"
     )
 
-    @model_validator(mode='after')
-    def validate_answer_presence(self) -> 'DecisionMakingOutput':
-        if not self.requires_research and not self.answer:
+    plan: Optional[str] = Field(
+        ...,
+        description="Plan de investigación paso a paso si se requiere investigación"
+    )
+
+    @field_validator('answer')
+    @classmethod
+    def validate_answer_presence(cls, value: Optional[str], info: ValidationInfo) -> Optional[str]:
+        if info.data.get('requires_research') is False and not value:
             raise ValueError("Se requiere una respuesta cuando no hay necesidad de investigación")
-        return self
+        return value
+
+    @field_validator('plan')
+    @classmethod
+    def validate_plan_presence(cls, value: Optional[str], info: ValidationInfo) -> Optional[str]:
+        if info.data.get('requires_research') and not value:
+            raise ValueError("Se requiere un plan cuando la consulta necesita investigación")
+        return value
 
 class JudgeOutput(BaseModel):
     """Output estructurado del nodo de evaluación de calidad"""
@@ -95,15 +111,16 @@ class JudgeOutput(BaseModel):
     
     # También quitamos min_length, max_length de 'feedback' si causara problemas
     feedback: Optional[str] = Field(
-        default=None,
+        ...,
         description="Feedback detallado para mejorar la respuesta",
     )
 
-    @model_validator(mode='after')
-    def validate_feedback_presence(self) -> 'JudgeOutput':
-        if not self.is_good_answer and not self.feedback:
+    @field_validator('feedback')
+    @classmethod
+    def validate_feedback_presence(cls, value: Optional[str], info: ValidationInfo) -> Optional[str]:
+        if info.data.get('is_good_answer') is False and not value:
             raise ValueError("Se requiere feedback cuando la respuesta no es satisfactoria")
-        return self
+        return value
 
 SearchStep = Literal["decision_making", "planning", "tools", "agent", "judge"]
 ValidationResult = Annotated[dict, Field(description="Resultado de validación del estado")]
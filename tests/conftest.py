@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# Los módulos del proyecto son planos en la raíz del repositorio
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# graph construye el grafo al importarse y exige la clave; las pruebas no llaman a la API
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("CORE_API_KEY", "test")
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+import graph
+from state import JudgeOutput
+
+
+class _FakeStructuredLLM:
+    """Juez falso: registra las llamadas y aprueba siempre."""
+    def __init__(self):
+        self.calls = 0
+
+    def invoke(self, messages):
+        self.calls += 1
+        return {
+            "raw": AIMessage(content=""),
+            "parsed": JudgeOutput(is_good_answer=True, feedback=None),
+            "parsing_error": None
+        }
+
+
+class _FakeConfig:
+    judge_model = "gpt-4o-mini"
+    max_history_tokens = 100_000
+    max_feedback_attempts = 2
+
+    def __init__(self, llm):
+        self._llm = llm
+
+    def initialize_llms(self, model=None):
+        return None
+
+    def structured_llm(self, schema, model=None):
+        return self._llm
+
+
+@pytest.fixture
+def judge(monkeypatch):
+    # Sin compactación: el historial de las pruebas es corto y no se cuenta con tiktoken
+    monkeypatch.setattr(graph, "compact_messages", lambda messages, *args: messages)
+    llm = _FakeStructuredLLM()
+    node = graph.setup_judge_node(_FakeConfig(llm))
+
+    def _run(content: str):
+        state = {
+            "messages": [HumanMessage(content="pregunta"), AIMessage(content=content)],
+            "num_feedback_requests": 0
+        }
+        return asyncio.run(node(state)), llm.calls
+
+    return _run
+
+
+def _answer(length: int, citation: bool = False) -> str:
+    suffix = " [1]" if citation else ""
+    return "a" * (length - len(suffix)) + suffix
+
+
+def test_rejects_answers_under_50_chars(judge):
+    output, calls = judge(_answer(49))
+    assert output["is_good_answer"] is False
+    assert output["messages"][0].content == "FEEDBACK:\nResponse too short"
+    assert calls == 0
+
+
+@pytest.mark.parametrize("length", [50, 199])
+def test_short_answers_go_to_the_llm_judge(judge, length):
+    output, calls = judge(_answer(length, citation=True))
+    assert output["is_good_answer"] is True
+    assert calls == 1
+
+
+def test_cited_answers_over_200_chars_skip_the_llm_judge(judge):
+    output, calls = judge(_answer(201, citation=True))
+    assert output == {"is_good_answer": True}
+    assert calls == 0
+
+
+def test_uncited_answers_over_200_chars_go_to_the_llm_judge(judge):
+    _, calls = judge(_answer(201))
+    assert calls == 1
+
+
+def test_agent_error_fallback_is_not_sent_back_for_revision(judge):
+    output, calls = judge(graph._AGENT_ERROR_MESSAGE)
+    assert output == {"is_good_answer": True}
+    assert calls == 0
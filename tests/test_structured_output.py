@@ -0,0 +1,33 @@
+import pytest
+
+from graph import GraphConfiguration
+from state import DecisionAndPlanOutput, JudgeOutput
+
+
+def _find_response_format(runnable):
+    """Busca el response_format enlazado dentro de la cadena de with_structured_output."""
+    kwargs = getattr(runnable, "kwargs", None)
+    if isinstance(kwargs, dict) and "response_format" in kwargs:
+        return kwargs["response_format"]
+
+    children = [getattr(runnable, attr, None) for attr in ("bound", "first", "last")]
+    children += list(getattr(runnable, "middle", None) or ())
+    children += list((getattr(runnable, "steps__", None) or {}).values())
+    for child in children:
+        if child is not None:
+            found = _find_response_format(child)
+            if found is not None:
+                return found
+    return None
+
+
+@pytest.mark.parametrize("schema", [DecisionAndPlanOutput, JudgeOutput])
+def test_strict_response_format_requires_every_property(schema):
+    llm = GraphConfiguration().structured_llm(schema)
+    response_format = _find_response_format(llm)
+    assert response_format is not None
+
+    json_schema = response_format["json_schema"]
+    assert json_schema["strict"] is True
+    properties = json_schema["schema"]["properties"]
+    assert set(json_schema["schema"]["required"]) == set(properties)
@@ -1,21 +1,26 @@
 # utils.py - Versión Final Corregida
 import re
 import json
+import asyncio
 import logging
-import jsonschema
-from datetime import datetime
+import threading
+import tiktoken
+from datetime import date, datetime
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Optional, Dict, Any
 from langchain_core.tools import BaseTool
-from langchain_core.messages import BaseMessage
-from IPython.display import display, Markdown
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, AIMessage, ToolMessage
+from langchain_core.runnables import Runnable
 
 logger = logging.getLogger(__name__)
 
 def current_date():
-    return datetime.now().strftime("%Y-%m-%d")
+    return date.today().isoformat()
 
-decision_making_prompt = f"""**Role**: Senior Scientific Research Assistant
-**Current Date**: {current_date()}
+# La fecha se rellena al construir el prompt ({current_date}), no al importar el módulo
+decision_making_prompt = """**Role**: Senior Scientific Research Assistant
+**Current Date**: {current_date}
 
 # Objective:
 Determine if the user query requires:
@@ -66,6 +71,16 @@ Create a {max_steps}-step plan using available tools.
    - url: [First result URL]
 ```"""
 
+# Decisión y planificación en una sola llamada: en la rama de investigación
+# el plan se genera junto con la clasificación
+decision_and_planning_prompt = decision_making_prompt + """
+
+# If Research Is Required:
+Return `requires_research=true` and, in `plan`, a {max_steps}-step plan using the available tools.
+If not, return `requires_research=false` and the direct `answer`.
+
+# Available Tools:""" + planning_prompt.split("# Available Tools:", 1)[1]
+
 agent_prompt = """**Role**: AI Research Scientist
 
 # Guidelines:
@@ -110,7 +125,12 @@ def format_tools_description(tools: List[BaseTool]) -> str:
     tool_docs = []
     for tool in tools:
         try:
-            params = tool.args_schema.schema() if tool.args_schema else {}
+            if not tool.args_schema:
+                params = {}
+            elif hasattr(tool.args_schema, "model_json_schema"):
+                params = tool.args_schema.model_json_schema()
+            else:  # modelos pydantic v1
+                params = tool.args_schema.schema()
             param_table = "\n".join(
                 f"- **{name}**: {schema.get('description', '')} "
                 f"(Type: {schema.get('type', 'str')}, "
@@ -142,98 +162,277 @@ def format_tools_description(tools: List[BaseTool]) -> str:
     
     return "\n\n---\n\n".join(tool_docs)
 
+async def invoke_with_validation_retry(llm: Runnable, messages: List[BaseMessage], max_retries: int = 2):
+    """
+    Invoca un LLM con salida estructurada (include_raw=True) reintentando con la
+    salida inválida y su error de validación como feedback.
+
+    Los errores de validación son deterministas: se reintenta de inmediato, sin espera.
+    """
+    messages = list(messages)
+    for attempt in range(max_retries + 1):
+        # Cliente compartido entre sesiones (cada una con su event loop): llamada síncrona en un hilo
+        result = await asyncio.to_thread(llm.invoke, messages)
+        error = result["parsing_error"]
+        if error is None and result["parsed"] is not None:
+            return result["parsed"]
+        if error is None:
+            error = ValueError("La salida no contiene un objeto estructurado")
+        if attempt == max_retries:
+            raise error
+        logger.warning(f"Salida estructurada inválida (intento {attempt + 1}): {str(error)}")
+        messages.append(result["raw"])
+        messages.append(HumanMessage(
+            content=f"Your previous output failed validation: {error}. Return valid JSON matching the schema."
+        ))
+
+# Caracteres de cada output de herramienta que se envían al resumen
+_SUMMARY_CHARS_PER_TOOL = 4000
+
+# Resúmenes ya generados, por tool_call_ids resumidos: agente y juez reutilizan el mismo
+# resumen en cada paso (un solo llamado al LLM y un prefijo estable para la caché de prompts)
+_SUMMARY_CACHE_SIZE = 64
+_summary_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_summary_lock = threading.Lock()
+
+def _summarize_outputs(outputs: List[ToolMessage], llm: Runnable) -> str:
+    key = tuple(m.tool_call_id for m in outputs)
+    with _summary_lock:
+        summary = _summary_cache.get(key)
+        if summary is not None:
+            _summary_cache.move_to_end(key)
+            return summary
+
+    findings = "\n\n".join(f"[{m.name}]\n{str(m.content)[:_SUMMARY_CHARS_PER_TOOL]}" for m in outputs)
+    # Sin callbacks heredados: el resumen no debe emitirse como tokens de la respuesta
+    summary = llm.invoke([
+        SystemMessage(content="Summarize these prior research tool outputs concisely. "
+                              "Keep paper titles, authors, years, URLs/DOIs and key findings."),
+        HumanMessage(content=findings)
+    ], config={"callbacks": []}).content
+
+    with _summary_lock:
+        _summary_cache[key] = summary
+        while len(_summary_cache) > _SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+    return summary
+
+@lru_cache(maxsize=8)
+def _encoding_for(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def _count_tokens(messages: List[BaseMessage], model: str) -> int:
+    encoding = _encoding_for(model)
+    return sum(len(encoding.encode(str(m.content))) for m in messages)
+
+def compact_messages(messages: List[BaseMessage], llm: Runnable, model: str,
+                     max_tokens: int = 100_000) -> List[BaseMessage]:
+    """
+    Resume las rondas de herramientas anteriores cuando el historial excede max_tokens.
+
+    Se conserva intacta la última ronda (el AIMessage con tool_calls y sus ToolMessages);
+    las rondas previas se reemplazan por un único SystemMessage con el resumen, de modo
+    que no quedan tool_calls sin respuesta ni ToolMessages huérfanos.
+    """
+    if _count_tokens(messages, model) <= max_tokens:
+        return messages
+
+    last_round = max(
+        (i for i, m in enumerate(messages) if isinstance(m, AIMessage) and m.tool_calls),
+        default=None
+    )
+    if last_round is None:
+        return messages
+
+    prior = [
+        m for m in messages[:last_round]
+        if isinstance(m, ToolMessage) or (isinstance(m, AIMessage) and m.tool_calls)
+    ]
+    outputs = [m for m in prior if isinstance(m, ToolMessage)]
+    if not outputs:
+        return messages
+
+    summary = _summarize_outputs(outputs, llm)
+
+    removed = set(map(id, prior))
+    compacted: List[BaseMessage] = []
+    inserted = False
+    for m in messages:
+        if id(m) in removed:
+            if not inserted:
+                compacted.append(SystemMessage(content=f"Prior research summary:\n{summary}"))
+                inserted = True
+            continue
+        compacted.append(m)
+
+    logger.info(f"Historial compactado: {len(messages)} -> {len(compacted)} mensajes")
+    return compacted
+
+def _display_markdown(text: str) -> None:
+    # IPython solo se necesita en notebooks: se importa al mostrar el primer mensaje
+    from IPython.display import display, Markdown
+    display(Markdown(text))
+
+def _render_ai(msg: BaseMessage, tool_number: int) -> str:
+    formatted = _format_research_output(msg.content)
+    _display_markdown(f"**Analysis Preview**\n```markdown\n{formatted}\n```")
+    return formatted
+
+def _render_tool(msg: BaseMessage, tool_number: int) -> str:
+    formatted = _format_tool_data(msg.content)
+    _display_markdown(f"🔍 **Tool #{tool_number}**: {msg.name}\n```json\n{formatted}\n```")
+    return formatted
+
+# Render por tipo de mensaje; los demás tipos no se muestran
+_MESSAGE_RENDERERS = {"ai": _render_ai, "tool": _render_tool}
+
 async def print_stream(app, input: str) -> Optional[BaseMessage]:
     """Execute and display research workflow with scientific formatting"""
     session_header = f"### 🔬 Research Session - {datetime.now().strftime('%Y-%m-%d %H:%M')}\n**Query**: \"{input[:100]}{'...' if len(input) > 100 else ''}\""
-    display(Markdown(session_header))
+    _display_markdown(session_header)
     
     messages = []
+    # Identidad de los mensajes ya mostrados: evita comparar con __eq__ contra todo el historial
+    seen_ids = set()
     tool_counter = 1
+    # Último mensaje formateado: la salida final suele ser el último AIMessage ya mostrado
+    last_msg, last_formatted = None, None
     
     try:
         async for event in app.astream({"messages": [input]}, stream_mode="updates"):
             for node, updates in event.items():
                 current_messages = updates.get("messages", [])
                 for msg in current_messages:
-                    if msg not in messages:
+                    if id(msg) not in seen_ids:
+                        seen_ids.add(id(msg))
                         messages.append(msg)
                         
-                        if msg.type == "ai":
-                            display(Markdown(f"**Analysis Preview**\n```markdown\n{_format_research_output(msg.content)}\n```"))
-                        elif msg.type == "tool":
-                            display(Markdown(f"🔍 **Tool #{tool_counter}**: {msg.name}\n```json\n{_format_tool_data(msg.content)}\n```"))
+                        render = _MESSAGE_RENDERERS.get(msg.type)
+                        if render is None:
+                            continue
+                        # Formato y render en un hilo: no bloquean la recepción de eventos
+                        formatted = await asyncio.to_thread(render, msg, tool_counter)
+                        if render is _render_tool:
                             tool_counter += 1
+                        else:
+                            last_msg, last_formatted = msg, formatted
     
     except Exception as e:
         error_msg = f"❗ **Research Interrupted**\n```error\n{str(e)}\n```"
-        display(Markdown(error_msg))
+        _display_markdown(error_msg)
         logger.error(f"Research workflow failed: {str(e)}")
         return None
     
-    final_output = f"🎯 **Final Research Output**\n{_format_research_output(messages[-1].content)}"
-    display(Markdown(final_output))
+    if messages[-1] is not last_msg:
+        last_formatted = _format_research_output(messages[-1].content)
+    final_output = f"🎯 **Final Research Output**\n{last_formatted}"
+    await asyncio.to_thread(_display_markdown, final_output)
     
     return messages[-1] if messages else None
 
+async def print_stream_batch(app, inputs: List[str], max_concurrency: int = 4) -> List[Optional[BaseMessage]]:
+    """Ejecuta varias consultas concurrentemente sobre el mismo grafo compilado."""
+    # El contador de herramientas es local a cada print_stream: la numeración no se mezcla
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run(query: str) -> Optional[BaseMessage]:
+        async with semaphore:
+            return await print_stream(app, query)
+
+    return await asyncio.gather(*(_run(query) for query in inputs))
+
+# Patrones de formato compilados una sola vez; las palabras clave se resuelven
+# en una única pasada con una tabla de reemplazos
+_NBSP_RE = re.compile(r"(\d)\s([%‰°C])")
+_ENDASH_RE = re.compile(r"\b(\d+)\s*-\s*(\d+)\b")
+_KW_MAP = {
+    "hypothesis": "**hypothesis**",
+    "methodology": "**methodology**",
+    "p-value": "`p-value`",
+    "ci": "`CI`"
+}
+# La alternancia se deriva de la tabla: añadir palabras clave no añade pasadas
+_KW_RE = re.compile(
+    r"\b(" + "|".join(map(re.escape, sorted(_KW_MAP, key=len, reverse=True))) + r")\b",
+    re.IGNORECASE
+)
+
 def _format_research_output(text: str) -> str:
-    text = re.sub(r"(\d)\s([%‰°C])", r"\1\u00A0\2", text)
-    text = re.sub(r"(\d+)(\.)(\d+)", r"\1\2\3", text)
-    text = re.sub(r"\b(\d+)\s*-\s*(\d+)\b", r"\1–\2", text)
-    
-    keywords = {
-        r"\bhypothesis\b": "**hypothesis**",
-        r"\bmethodology\b": "**methodology**",
-        r"\bp-value\b": "`p-value`",
-        r"\bCI\b": "`CI`"
-    }
-    for pattern, replacement in keywords.items():
-        text = re.sub(pattern, replacement, text, flags=re.IGNORECASE)
-    
-    return text
+    text = _NBSP_RE.sub("\\1\u00A0\\2", text)
+    text = _ENDASH_RE.sub(r"\1–\2", text)
+    return _KW_RE.sub(lambda m: _KW_MAP[m.group(1).lower()], text)
+
+try:
+    import orjson
+
+    def _pretty_json(data: str) -> str:
+        return orjson.dumps(orjson.loads(data), option=orjson.OPT_INDENT_2).decode()
+except ImportError:  # orjson es opcional; json de la stdlib como respaldo
+    def _pretty_json(data: str) -> str:
+        return json.dumps(json.loads(data), indent=2)
+
+_TOOL_DATA_MAX_CHARS = 2000
 
 def _format_tool_data(data: str) -> str:
+    # El JSON indentado nunca es más corto que el original: si ya excede el límite
+    # se truncaría de todos modos, así que se recorta sin parsearlo
+    if len(data) > _TOOL_DATA_MAX_CHARS:
+        return data[:800] + "\n... [truncated] ...\n" + data[-800:]
     try:
-        json_data = json.loads(data)
-        formatted = json.dumps(json_data, indent=2)
-        if len(formatted) > 2000:
+        formatted = _pretty_json(data)
+        if len(formatted) > _TOOL_DATA_MAX_CHARS:
             return formatted[:800] + "\n... [truncated] ...\n" + formatted[-800:]
         return formatted
-    except json.JSONDecodeError:
-        return data[:2000]
+    except json.JSONDecodeError:  # orjson.JSONDecodeError es subclase
+        return data
 
-def validate_research_schema(data: Dict[str, Any]) -> bool:
-    schema = {
-        "type": "object",
-        "properties": {
-            "hypothesis": {"type": "string"},
-            "methodology": {"type": "string"},
-            "results": {
+_RESEARCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "hypothesis": {"type": "string"},
+        "methodology": {"type": "string"},
+        "results": {
+            "type": "object",
+            "properties": {
+                "sample_size": {"type": "integer"},
+                "confidence_interval": {"type": "array", "items": {"type": "number"}},
+                "p_value": {"type": "number"}
+            },
+            "required": ["sample_size"]
+        },
+        "citations": {
+            "type": "array",
+            "items": {
                 "type": "object",
                 "properties": {
-                    "sample_size": {"type": "integer"},
-                    "confidence_interval": {"type": "array", "items": {"type": "number"}},
-                    "p_value": {"type": "number"}
-                },
-                "required": ["sample_size"]
-            },
-            "citations": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "author": {"type": "string"},
-                        "year": {"type": "integer"},
-                        "doi": {"type": "string"}
-                    }
+                    "author": {"type": "string"},
+                    "year": {"type": "integer"},
+                    "doi": {"type": "string"}
                 }
             }
-        },
-        "required": ["hypothesis", "methodology"]
-    }
-    
+        }
+    },
+    "required": ["hypothesis", "methodology"]
+}
+
+@lru_cache(maxsize=1)
+def _research_validator():
+    """Validador compilado la primera vez que se usa; retorna (validar, tipo de error)."""
+    try:
+        import fastjsonschema
+        return fastjsonschema.compile(_RESEARCH_SCHEMA), fastjsonschema.JsonSchemaException
+    except ImportError:  # fastjsonschema es opcional; jsonschema con el esquema prevalidado como respaldo
+        import jsonschema
+        return jsonschema.Draft7Validator(_RESEARCH_SCHEMA).validate, jsonschema.ValidationError
+
+def validate_research_schema(data: Dict[str, Any]) -> bool:
+    validate, schema_error = _research_validator()
     try:
-        jsonschema.validate(instance=data, schema=schema)
+        validate(data)
         return True
-    except jsonschema.ValidationError as e:
+    except schema_error as e:
         logger.error(f"Schema validation failed: {str(e)}")
         return False